@@ -0,0 +1,522 @@
+﻿# -*- coding: utf-8 -*-
+# Нагрузочный стенд бота без Google и Telegram.
+# bot.py запускается как есть, но таблицы — листы в памяти с задержкой и
+# ошибками квоты 429, а Bot API — локальный aiohttp-сервер. Сценарии:
+#   shift_start    — все сотрудники одновременно начинают смену
+#   complete_order — «Начал работу» и весь диалог OrderForm до площади
+#   poll_orders    — WebApp опрашивает /api/orders с ETag, пока заказы меняются
+#   shift_end      — все одновременно завершают смену
+# Для каждого сценария: p50/p99 задержки, пропускная способность, сколько
+# запросов к Sheets и к Bot API приходится на одно действие.
+#
+#   python bench.py --workers 50 --orders 20000
+#   python bench.py --sheets-latency 0.3 --sheets-errors 0.05 --max-p99 500 --json bench.json
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import gspread
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_TOKEN = "123456:bench"
+BENCH_ADMIN_ID = 1
+WORKER_BASE_ID = 100000
+SCENARIOS = ("shift_start", "complete_order", "poll_orders", "shift_end")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд bot.py с поддельными Sheets и Bot API")
+    parser.add_argument("--workers", type=int, default=50, help="сколько сотрудников жмут кнопки одновременно")
+    parser.add_argument("--orders", type=int, default=20000, help="строк в листе заказов")
+    parser.add_argument("--flows", type=int, default=2, help="заказов, которые завершает каждый сотрудник")
+    parser.add_argument("--polls", type=int, default=20, help="опросов /api/orders на сотрудника")
+    parser.add_argument("--poll-churn", type=float, default=5, help="изменений заказов в секунду во время опроса")
+    parser.add_argument("--think", type=float, default=0, help="пауза сотрудника между шагами, с")
+    parser.add_argument("--storage", choices=("sqlite", "sheets"), default="sqlite", help="STORAGE_BACKEND бота")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="задержка вызова Sheets, с")
+    parser.add_argument("--sheets-errors", type=float, default=0, help="доля вызовов Sheets с ошибкой 429")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument("--api-errors", type=float, default=0, help="доля запросов Bot API с ошибкой 429")
+    parser.add_argument("--drain-timeout", type=float, default=180, help="сколько ждать, пока уйдёт очередь записи, с")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="только эти сценарии (можно несколько)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    parser.add_argument("--max-p99", type=float, help="код выхода 1, если p99 сценария больше, мс")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return parser.parse_args()
+
+# Ответ Google при превышении квоты — столько, сколько читает gspread.APIError
+class QuotaResponse:
+    status_code = 429
+    text = "Quota exceeded"
+
+    def __init__(self, retry_after: float):
+        self.headers = {"Retry-After": str(retry_after)}
+
+    def json(self):
+        return {"error": {"code": 429, "message": "Quota exceeded for quota metric 'Write requests'",
+                          "status": "RESOURCE_EXHAUSTED"}}
+
+# Подделка Google Sheets: листы бота (FakeWorksheet) за обёрткой, которая
+# считает вызовы, ждёт latency и с вероятностью error_rate отвечает 429.
+# Вызовы идут из пула шлюза бота, поэтому задержка — блокирующий sleep.
+class FakeSheets:
+    def __init__(self, latency: float, error_rate: float, retry_after: float = 1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.faults = False   # ошибки включаются после прогрева кэшей
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.worksheets = {}
+
+    def open(self, worksheet):
+        self.worksheets[worksheet.title] = worksheet
+        return FlakyWorksheet(worksheet, self)
+
+    def hit(self, method: str):
+        with self.lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.faults and random.random() < self.error_rate:
+            with self.lock:
+                self.calls["quota_errors"] += 1
+            raise gspread.exceptions.APIError(QuotaResponse(self.retry_after))
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls)
+
+class FlakyWorksheet:
+    METHODS = ("get_all_values", "get_all_records", "get", "row_values",
+               "append_row", "append_rows", "update_cell", "batch_update")
+
+    def __init__(self, worksheet, sheets: FakeSheets):
+        self.worksheet = worksheet
+        self.sheets = sheets
+        self.title = worksheet.title
+
+    def __getattr__(self, name):
+        method = getattr(self.worksheet, name)
+        if name not in self.METHODS:
+            return method
+
+        @functools.wraps(method)
+        def call(*args, **kwargs):
+            self.sheets.hit(name)
+            return method(*args, **kwargs)
+        return call
+
+# Подделка Bot API: принимает любой метод, отвечает правдоподобным результатом
+class FakeBotAPI:
+    MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "sendLocation",
+                       "editMessageText", "editMessageReplyMarkup", "forwardMessage", "copyMessage"}
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            self.calls["retry_after"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def result(self, method: str, params):
+        if method == "getMe":
+            return {"id": int(BENCH_TOKEN.split(":")[0]), "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getFile":
+            file_id = params.get("file_id", "file")
+            return {"file_id": file_id, "file_unique_id": file_id[:32], "file_size": 0, "file_path": f"photos/{file_id}.jpg"}
+        if method in self.MESSAGE_METHODS:
+            return {
+                "message_id": int(params.get("message_id") or next(self.message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("POST", "/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def snapshot(self):
+        return Counter(self.calls)
+
+# Сколько ошибок бот записал в лог за сценарий
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+def worker_name(index: int):
+    return f"Сотрудник {index:03d}"
+
+# Лист заказов: история за 90 дней и по flows + 1 назначенных заказов на сотрудника
+def seed_orders(headers: list, total: int, workers: int, flows: int):
+    now = datetime.now()
+    rows = [list(headers)]
+    assigned = workers * (flows + 1)
+    for order_id in range(1, total + 1):
+        index = order_id % workers
+        created = now - timedelta(minutes=random.randint(60, 90 * 24 * 60))
+        done = order_id > assigned
+        record = {
+            "№ заказа": order_id,
+            "Адрес": f"ул. Тестовая, {order_id}",
+            "Тип работы": random.choice(("Дезинсекция", "Дератизация", "Обработка участка")),
+            "Срок": (created + timedelta(days=3)).strftime("%d.%m.%Y"),
+            "Комментарий": "",
+            "Приоритет": "срочный" if order_id % 17 == 0 else "обычный",
+            "Статус": "Выполнен" if done else "Назначен, не начат",
+            "Ответственный": worker_name(index),
+            "ID исполнителя": WORKER_BASE_ID + index,
+            "Дата создания": created.strftime("%d.%m.%Y %H:%M"),
+            "Координаты": f"{55.6 + random.random() * 0.3:.5f}, {37.4 + random.random() * 0.4:.5f}",
+        }
+        if done:
+            record.update({
+                "Начал работу": (created + timedelta(hours=2)).strftime("%d.%m.%Y %H:%M"),
+                "Выполнил работу": (created + timedelta(hours=3)).strftime("%d.%m.%Y %H:%M"),
+                "Сумма": random.randint(15, 120) * 100,
+                "Способ оплаты": random.choice(("наличными", "переводом", "qr")),
+                "Препарат": random.choice(("Дельтаметрин", "Циперметрин")),
+                "Количество": random.randint(1, 10),
+                "Площадь": random.randint(4, 30),
+                "Фото чека": "без чека",
+            })
+        rows.append([record.get(column, "") for column in headers])
+    return rows
+
+def percentile(samples: list, p: float):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+class Bench:
+    def __init__(self, args, module, sheets: FakeSheets, api: FakeBotAPI):
+        self.args = args
+        self.app = module
+        self.sheets = sheets
+        self.api = api
+        self.errors = ErrorCounter()
+        logging.getLogger().addHandler(self.errors)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.workers = {WORKER_BASE_ID + i: worker_name(i) for i in range(args.workers)}
+        self.results = []
+        self.poll_statuses = {}
+        self.failed = 0   # обновления, исключение из которых дошло до стенда
+
+    # --- Обновления Telegram ---
+
+    def _user(self, user_id: int):
+        return {"id": user_id, "is_bot": False, "first_name": self.workers.get(user_id, "Admin")}
+
+    def _message(self, user_id: int, text: str, from_bot: bool = False):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "Bench"} if from_bot else self._user(user_id),
+            "text": text,
+        }
+
+    async def _feed(self, payload: dict):
+        update = self.app.types.Update.model_validate(
+            {"update_id": next(self.update_ids), **payload}, context={"bot": self.app.bot},
+        )
+        started = time.perf_counter()
+        try:
+            await self.app.dp.feed_update(self.app.bot, update)
+        except Exception:
+            self.failed += 1
+        return time.perf_counter() - started
+
+    async def press(self, user_id: int, data: str):
+        return await self._feed({"callback_query": {
+            "id": str(next(self.message_ids)),
+            "from": self._user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": self._message(user_id, "📋 Меню", from_bot=True),
+        }})
+
+    async def say(self, user_id: int, text: str):
+        return await self._feed({"message": self._message(user_id, text)})
+
+    # --- Замер сценария ---
+
+    async def measure(self, name: str, unit: str, run):
+        sheets_before, api_before, errors_before = self.sheets.snapshot(), self.api.snapshot(), self.errors.count
+        failed_before = self.failed
+        samples = []
+        started = time.perf_counter()
+        await run(samples)
+        elapsed = time.perf_counter() - started
+        drained = await self.drain()
+        sheets_calls = self.sheets.snapshot() - sheets_before
+        api_calls = self.api.snapshot() - api_before
+        actions = max(len(samples), 1)
+        quota_errors = sheets_calls.pop("quota_errors", 0)
+        api_retry_after = api_calls.pop("retry_after", 0)
+        result = {
+            "scenario": name,
+            "unit": unit,
+            "actions": len(samples),
+            "seconds": round(elapsed, 3),
+            "throughput": round(len(samples) / elapsed, 1) if elapsed else 0,
+            "p50_ms": round(percentile(samples, 50) * 1000, 1),
+            "p99_ms": round(percentile(samples, 99) * 1000, 1),
+            "max_ms": round(max(samples, default=0) * 1000, 1),
+            "sheets_calls": dict(sheets_calls),
+            "sheets_per_action": round(sum(sheets_calls.values()) / actions, 3),
+            "sheets_quota_errors": quota_errors,
+            "api_calls": dict(api_calls),
+            "api_per_action": round(sum(api_calls.values()) / actions, 3),
+            "api_retry_after": api_retry_after,
+            "logged_errors": self.errors.count - errors_before,
+            "failed_updates": self.failed - failed_before,
+            "write_queue_drained": drained,
+            "outbox_backlog": self.app.outbox.queue.qsize(),
+        }
+        self.results.append(result)
+        return result
+
+    # Запись в Sheets отложенная — вызовы сценария заканчиваются, когда очередь пуста.
+    # Уведомления админам не ждём: их копится больше, чем уходит за секунду, остаток
+    # виден в outbox_backlog.
+    async def drain(self):
+        deadline = time.monotonic() + self.args.drain_timeout
+        while self.app.write_queue.size():
+            if time.monotonic() > deadline:
+                return False
+            self.app.write_queue.wakeup.set()
+            await asyncio.sleep(0.1)
+        return True
+
+    async def storm(self, samples: list, action):
+        gate = asyncio.Event()
+
+        async def one(user_id):
+            await gate.wait()
+            samples.append(await action(user_id))
+        tasks = [asyncio.create_task(one(user_id)) for user_id in self.workers]
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(*tasks)
+
+    # --- Сценарии ---
+
+    async def shift_start(self, samples: list):
+        await self.storm(samples, lambda user_id: self.press(user_id, "shift_start"))
+
+    async def shift_end(self, samples: list):
+        await self.storm(samples, lambda user_id: self.press(user_id, "shift_end"))
+
+    def current_order(self, user_id: int):
+        records = self.app.orders_repo.active_for(user_id)
+        working = [record for record in records if record["Статус"] == "В работе"]
+        return (working or records or [None])[0]
+
+    async def complete_orders(self, user_id: int, samples: list):
+        steps = [("press", "done_{id}"), ("say", "2500"), ("press", "payment_наличными"),
+                 ("say", "без чека"), ("say", "Дельтаметрин"), ("say", "2"), ("say", "12")]
+        for _ in range(self.args.flows):
+            record = self.current_order(user_id)
+            if record is None:
+                return
+            order_id = record["№ заказа"]
+            if record["Статус"] != "В работе":
+                samples.append(await self.press(user_id, f"start_{order_id}"))
+            for kind, value in steps:
+                if self.args.think:
+                    await asyncio.sleep(self.args.think)
+                value = value.format(id=order_id)
+                samples.append(await (self.press(user_id, value) if kind == "press" else self.say(user_id, value)))
+
+    async def complete_order(self, samples: list):
+        await asyncio.gather(*(self.complete_orders(user_id, samples) for user_id in self.workers))
+
+    async def poll_orders(self, samples: list):
+        server = TestServer(self.app.create_app())
+        await server.start_server()
+        stop = asyncio.Event()
+        statuses = Counter()
+
+        # Пока WebApp опрашивает, заказы кто-то меняет — иначе ETag всегда совпадает
+        async def churn():
+            ids = [record["№ заказа"] for record in self.app.orders_repo.all() if record["Статус"] != "Выполнен"]
+            while ids and not stop.is_set() and self.args.poll_churn > 0:
+                await self.app.orders_repo.patch(random.choice(ids), {"Комментарий": f"правка {time.time():.3f}"})
+                await asyncio.sleep(1 / self.args.poll_churn)
+
+        async def poll(session, user_id):
+            etag = None
+            for _ in range(self.args.polls):
+                headers = {"If-None-Match": etag} if etag else {}
+                started = time.perf_counter()
+                async with session.get(server.make_url("/api/orders"), params={"assignee": str(user_id)},
+                                       headers=headers) as response:
+                    await response.read()
+                    samples.append(time.perf_counter() - started)
+                    statuses[response.status] += 1
+                    etag = response.headers.get("ETag", etag)
+                await asyncio.sleep(random.uniform(0, 0.05))
+
+        churn_task = asyncio.create_task(churn())
+        try:
+            async with ClientSession() as session:
+                await asyncio.gather(*(poll(session, user_id) for user_id in self.workers))
+        finally:
+            stop.set()
+            await churn_task
+            await server.close()
+        self.poll_statuses = dict(statuses)
+
+    # --- Запуск ---
+
+    async def warm_up(self):
+        sheets_before = self.sheets.snapshot()
+        started = time.perf_counter()
+        await self.app.warm_up()
+        result = {
+            "scenario": "warm_up",
+            "seconds": round(time.perf_counter() - started, 3),
+            "orders": len(self.app.orders_repo.records),
+            "sheets_calls": dict(self.sheets.snapshot() - sheets_before),
+        }
+        self.results.append(result)
+        return result
+
+    async def run(self):
+        warm = await self.warm_up()
+        print(f"Прогрев: {warm['orders']} заказов за {warm['seconds']} с, вызовы Sheets: {warm['sheets_calls']}")
+        self.sheets.faults = True
+        units = {"shift_start": "нажатие", "complete_order": "шаг диалога", "poll_orders": "запрос", "shift_end": "нажатие"}
+        for name in self.args.scenario or SCENARIOS:
+            result = await self.measure(name, units[name], getattr(self, name))
+            if name == "poll_orders":
+                result["http_statuses"] = self.poll_statuses
+            print_result(result)
+        return self.results
+
+def print_result(result: dict):
+    print(
+        f"\n{result['scenario']}: {result['actions']} × {result['unit']} за {result['seconds']} с "
+        f"({result['throughput']}/с)\n"
+        f"  задержка: p50 {result['p50_ms']} мс, p99 {result['p99_ms']} мс, max {result['max_ms']} мс\n"
+        f"  Sheets: {result['sheets_per_action']} вызова на действие {result['sheets_calls']}, "
+        f"ошибок 429: {result['sheets_quota_errors']}"
+        f"{'' if result['write_queue_drained'] else ', очередь записи НЕ разобрана'}\n"
+        f"  Bot API: {result['api_per_action']} вызова на действие {result['api_calls']}, "
+        f"ошибок 429: {result['api_retry_after']}\n"
+        f"  ошибок в логе: {result['logged_errors']}, необработанных обновлений: {result['failed_updates']}, уведомлений в очереди: {result['outbox_backlog']}"
+        + (f"\n  ответы: {result['http_statuses']}" if "http_statuses" in result else "")
+    )
+
+async def run_bench(args):
+    api = FakeBotAPI(args.api_latency, args.api_errors)
+    await api.start()
+
+    # Окружение задаётся до импорта: bot.py читает настройки при загрузке
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "ADMIN_IDS": str(BENCH_ADMIN_ID),
+        "BOT_MODE": "polling",
+        "TELEGRAM_API_URL": api.url,
+        "SHEETS_MODE": "fake",
+        "STORAGE_BACKEND": args.storage,
+    })
+    sys.path.insert(0, ROOT)
+    import bot as module
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    sheets = FakeSheets(args.sheets_latency, args.sheets_errors)
+    orders = module.FakeWorksheet("Заказы на участки")
+    orders.rows = seed_orders(module.ORDER_HEADERS, args.orders, args.workers, args.flows)
+    team = module.FakeWorksheet(module.ROSTER_SHEET, module.ROSTER_HEADERS)
+    seeded = {
+        orders.title: orders,
+        "Учёт смен": module.FakeWorksheet("Учёт смен", module.SHIFT_HEADERS),
+        team.title: team,
+    }
+    module.open_worksheet = lambda title, headers: sheets.open(seeded[title])
+
+    bench = Bench(args, module, sheets, api)
+    team.rows.append([str(BENCH_ADMIN_ID), "Администратор", "admin"])
+    team.rows.extend([str(user_id), name, "worker"] for user_id, name in bench.workers.items())
+    await module.roster.load_sheet()
+    tasks = [asyncio.create_task(job) for job in (module.write_queue.run(), module.outbox.run(), module.locations.run())]
+    try:
+        return await bench.run()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await module.bot.session.close()
+        await api.stop()
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    # Базы, очереди и медиа бота создаются в рабочей папке — берём временную
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            results = asyncio.run(run_bench(args))
+        finally:
+            os.chdir(cwd)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    slow = [r["scenario"] for r in results if args.max_p99 is not None and r.get("p99_ms", 0) > args.max_p99]
+    if slow:
+        print(f"\n❌ p99 выше {args.max_p99} мс: {', '.join(slow)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,45 @@
 ﻿# -*- coding: utf-8 -*-
 import asyncio
+import bisect
 from aiogram import F
 import os
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import WebAppInfo
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+import functools
+import hashlib
+import hmac
+import io
 import logging
 import json
+import math
+import random
+import re
+import shlex
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import parse_qsl
 from aiohttp import web
 import aiohttp_cors
 
@@ -25,58 +50,2402 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Время старта процесса — от него считаются замеры холодного запуска
+PROCESS_STARTED = time.monotonic()
+
 # Загружаем переменные окружения
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_IDS", "").split(",") if id.strip()]
+# Администраторы из окружения нужны только для первого заполнения состава команды,
+# дальше роли хранятся в составе (см. Roster)
+BOOTSTRAP_ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_IDS", "").split(",") if id.strip()]
+
+# Режим получения обновлений: polling — для локальной разработки, webhook — для сервера.
+# В режиме webhook Telegram шлёт обновления на WEBHOOK_URL + WEBHOOK_PATH
+# (на Render адрес сервиса берётся из RENDER_EXTERNAL_URL)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL", "")).rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Telegram принимает в секрете только буквы, цифры, "_" и "-"
+WEBHOOK_SECRET = re.sub(r"[^A-Za-z0-9_-]", "", os.getenv("WEBHOOK_SECRET", ""))[:256] or \
+    hashlib.sha256((BOT_TOKEN or "").encode()).hexdigest()
+
+# Свой сервер Bot API (telegram-bot-api или заглушка из bench.py) вместо api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Инициализация бота; диспетчер создаётся ниже, после хранилища состояний диалогов
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
+
+# Метрики в текстовом формате Prometheus (GET /metrics). Счётчики, датчики и
+# гистограммы с метками хранятся в словарях; всё, что меряется, проходит через
+# цикл событий, поэтому блокировки не нужны.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counters = {}    # (имя, метки) → значение
+        self.gauges = {}
+        self.histograms = {}  # (имя, метки) → [количество по корзинам, сумма, количество]
+        self.collectors = []  # обновляют датчики перед каждой выдачей
+
+    @staticmethod
+    def _key(name: str, labels: dict = None):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, labels: dict = None, value: float = 1):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, labels: dict = None):
+        self.gauges[self._key(name, labels)] = value
+
+    # Датчик с меняющимися метками (например, состояния диалогов) пересобирается целиком
+    def reset(self, name: str):
+        for key in [key for key in self.gauges if key[0] == name]:
+            del self.gauges[key]
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def collector(self, func):
+        self.collectors.append(func)
+        return func
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{metric_label(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрик {collect.__name__}: {e}")
+        lines = []
+        for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+            typed = set()
+            for (name, labels), value in sorted(series.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        typed = set()
+        for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def metric_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics(METRICS_BUCKETS)
+
+# Каждый запрос к Bot API: метод, исход и время ответа
+async def track_telegram_call(make_request, bot, method):
+    name = type(method).__name__
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await make_request(bot, method)
+        outcome = "ok"
+        return result
+    except TelegramRetryAfter:
+        outcome = "retry_after"
+        raise
+    finally:
+        metrics.inc("telegram_api_calls_total", {"method": name, "outcome": outcome})
+        metrics.observe("telegram_api_duration_seconds", time.perf_counter() - started, {"method": name})
+
+bot.session.middleware(track_telegram_call)
+
+# Сотрудники для первого заполнения пустого состава: {Telegram ID: "Имя Фамилия"}
+ROSTER_DEFAULT = {
+    693411047: "Баранов Антон",
+    987654321: "Петрова Мария",
+    555666777: "Сидоров Дмитрий"
+}
+
+# Режим работы с Google Sheets: google — настоящие таблицы, fake — таблицы в памяти
+# (тесты и работа без Google), off — без таблиц, только локальное хранилище
+SHEETS_MODE = os.getenv("SHEETS_MODE", "google")
+
+# Подключение к Google Sheets — ИСПРАВЛЕНО! Само подключение выполняется в фоне при запуске
+scope = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+client = None
+
+# Шлюз к Google Sheets: синхронный gspread выполняется в ограниченном пуле потоков,
+# чтобы медленный запрос не останавливал цикл событий бота и веб-сервера
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "4"))
+SHEETS_CALL_TIMEOUT = float(os.getenv("SHEETS_CALL_TIMEOUT", "20"))
+
+class SheetsGateway:
+    def __init__(self, max_workers: int, timeout: float):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.timeout = timeout
+
+    async def call(self, func, *args, timeout: float = None, **kwargs):
+        loop = asyncio.get_running_loop()
+        method = getattr(func, "__name__", "call")
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            async with self.semaphore:
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs)),
+                    timeout or self.timeout,
+                )
+            outcome = "ok"
+            return result
+        except Exception as e:
+            if getattr(getattr(e, "response", None), "status_code", None) == 429:
+                outcome = "quota"
+            raise
+        finally:
+            metrics.inc("sheets_calls_total", {"method": method, "outcome": outcome})
+            metrics.observe("sheets_call_duration_seconds", time.perf_counter() - started, {"method": method})
+
+sheets = SheetsGateway(SHEETS_MAX_WORKERS, SHEETS_CALL_TIMEOUT)
+
+# Колонки таблицы заказов (номер колонки = позиция + 1)
+ORDER_HEADERS = [
+    "№ заказа", "Адрес", "Тип работы", "Срок", "Комментарий",
+    "Приоритет", "Статус", "Ответственный", "Дата создания",
+    "Начал работу", "Выполнил работу", "Сумма", "Способ оплаты",
+    "Препарат", "Количество", "Площадь", "Фото чека", "Координаты",
+    "Прибыл на объект", "Покинул объект", "ID исполнителя"
+]
+ORDER_COLUMNS = {name: i + 1 for i, name in enumerate(ORDER_HEADERS)}
+
+SHIFT_HEADERS = [
+    "ID сотрудника", "Имя сотрудника", "Дата", "Начало смены",
+    "Окончание смены", "Отработано (ч)", "Статус", "ID смены"
+]
+SHIFT_COLUMNS = {name: i + 1 for i, name in enumerate(SHIFT_HEADERS)}
+
+# Лист в памяти с тем же интерфейсом, что у gspread.Worksheet
+class FakeWorksheet:
+    def __init__(self, title: str, headers: list = None):
+        self.title = title
+        self.rows = [list(headers)] if headers else []
+        self.lock = threading.Lock()
+
+    def get_all_values(self):
+        with self.lock:
+            return [list(row) for row in self.rows]
+
+    def get_all_records(self):
+        values = self.get_all_values()
+        return [dict(zip(values[0], row)) for row in values[1:]] if values else []
+
+    # Поддерживаются диапазоны колонок вида "A:D"
+    def get(self, a1_range: str):
+        first, last = a1_range.split(":")
+        start, end = column_number(first) - 1, column_number(last)
+        with self.lock:
+            return [row[start:end] for row in self.rows]
+
+    def append_row(self, values: list, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, rows: list, **kwargs):
+        with self.lock:
+            first_row = len(self.rows) + 1
+            self.rows.extend([cell_text(value) for value in row] for row in rows)
+            last_row = len(self.rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{first_row}:A{last_row}"}}
+
+    def update_cell(self, row: int, col: int, value):
+        with self.lock:
+            self._set(row, col, value)
+
+    def batch_update(self, data: list, **kwargs):
+        with self.lock:
+            for item in data:
+                row, col = gspread.utils.a1_to_rowcol(item["range"].split(":")[0])
+                for offset, value in enumerate(item["values"][0]):
+                    self._set(row, col + offset, value)
+
+    def _set(self, row: int, col: int, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        cells.extend([""] * (col - len(cells)))
+        cells[col - 1] = cell_text(value)
+
+def cell_text(value):
+    return "" if value is None else str(value)
+
+def column_number(letters: str):
+    number = 0
+    for letter in letters.upper():
+        number = number * 26 + ord(letter) - ord("A") + 1
+    return number
+
+def open_worksheet(title: str, headers: list):
+    if SHEETS_MODE == "fake":
+        return FakeWorksheet(title, headers)
+    try:
+        worksheet = client.open(title).sheet1
+    except gspread.SpreadsheetNotFound:
+        logger.error(f"Таблица '{title}' не найдена.")
+        raise Exception(f"❌ Таблица '{title}' не найдена. Создайте её в Google Таблицах.")
+    # Создаём заголовки, если таблица пустая, и дописываем новые колонки
+    existing = worksheet.row_values(1)
+    if not existing:
+        worksheet.append_row(headers)
+    elif len(existing) < len(headers) and existing == headers[:len(existing)]:
+        worksheet.batch_update([row_range(1, len(existing) + 1, headers[len(existing):])])
+    return worksheet
+
+# Очередь отложенной записи в Google Sheets. Обработчики меняют кэш и кладут
+# запись в локальную SQLite-очередь, а фоновая задача отправляет её пачками:
+# добавления строк — одним append_rows, изменения ячеек — одним batch_update.
+# Повторные изменения одной ячейки схлопываются, при ошибках — экспоненциальная
+# пауза, очередь переживает перезапуск.
+WRITE_QUEUE_PATH = os.getenv("WRITE_QUEUE_PATH", "write_queue.db")
+WRITE_QUEUE_WINDOW = float(os.getenv("WRITE_QUEUE_WINDOW", "0.5"))
+WRITE_QUEUE_INTERVAL = float(os.getenv("WRITE_QUEUE_INTERVAL", "5"))
+WRITE_QUEUE_BATCH = int(os.getenv("WRITE_QUEUE_BATCH", "200"))
+WRITE_QUEUE_MAX_ATTEMPTS = int(os.getenv("WRITE_QUEUE_MAX_ATTEMPTS", "10"))
+WRITE_QUEUE_MAX_BACKOFF = float(os.getenv("WRITE_QUEUE_MAX_BACKOFF", "300"))
+# Квота Sheets API — 60 запросов на запись в минуту на пользователя
+SHEETS_WRITES_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", "50"))
+
+class WriteBehindQueue:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sheet_writes ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT NOT NULL, op TEXT NOT NULL, "
+            "row_key TEXT, payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sheet_writes_failed ("
+            "seq INTEGER PRIMARY KEY, target TEXT NOT NULL, op TEXT NOT NULL, "
+            "row_key TEXT, payload TEXT NOT NULL, error TEXT)"
+        )
+        self.db.commit()
+        self.targets = {}
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.request_times = deque()
+        self.failures = 0
+
+    def register(self, name: str, target):
+        self.targets[name] = target
+
+    def _put(self, target: str, op: str, key, payload):
+        self.db.execute(
+            "INSERT INTO sheet_writes (target, op, row_key, payload) VALUES (?, ?, ?, ?)",
+            (target, op, None if key is None else str(key), json.dumps(payload, ensure_ascii=False)),
+        )
+        self.db.commit()
+        self.wakeup.set()
+
+    def append(self, target: str, key, row: list):
+        self._put(target, "append", key, row)
+
+    def patch(self, target: str, key, changes: dict):
+        self._put(target, "patch", key, changes)
+
+    def pending(self, target: str):
+        rows = self.db.execute(
+            "SELECT op, row_key, payload FROM sheet_writes WHERE target = ? ORDER BY seq", (target,)
+        ).fetchall()
+        return [(op, key, json.loads(payload)) for op, key, payload in rows]
+
+    def size(self):
+        return self.db.execute("SELECT COUNT(*) FROM sheet_writes").fetchone()[0]
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), WRITE_QUEUE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            # Небольшое окно, чтобы собрать в пачку изменения соседних нажатий
+            await asyncio.sleep(WRITE_QUEUE_WINDOW)
+            self.wakeup.clear()
+            try:
+                while True:
+                    async with self.lock:
+                        if not await self.flush_batch():
+                            break
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                delay = self._backoff(e)
+                logger.error(f"Ошибка записи в Google Sheets (попытка {self.failures}), повтор через {delay:.0f} с: {e}")
+                await asyncio.sleep(delay)
+                self.wakeup.set()
+
+    def _backoff(self, error: Exception):
+        delay = min(WRITE_QUEUE_MAX_BACKOFF, 2 ** self.failures) * random.uniform(0.8, 1.2)
+        response = getattr(error, "response", None)
+        if response is not None and getattr(response, "status_code", None) == 429:
+            retry_after = response.headers.get("Retry-After")
+            delay = max(delay, float(retry_after) if retry_after else 60 / max(SHEETS_WRITES_PER_MINUTE, 1) * 10)
+        return delay
+
+    # Ограничиваем частоту запросов, не дожидаясь 429 от Google
+    async def _throttle(self):
+        now = time.monotonic()
+        while self.request_times and now - self.request_times[0] > 60:
+            self.request_times.popleft()
+        if len(self.request_times) >= SHEETS_WRITES_PER_MINUTE:
+            await asyncio.sleep(60 - (now - self.request_times[0]))
+        self.request_times.append(time.monotonic())
+
+    async def flush_batch(self):
+        # Листы, к которым ещё нет подключения, ждут в очереди
+        names = [name for name, target in self.targets.items() if target.worksheet is not None]
+        if not names:
+            return False
+        rows = self.db.execute(
+            "SELECT seq, target, op, row_key, payload, attempts FROM sheet_writes "
+            f"WHERE target IN ({','.join('?' * len(names))}) ORDER BY seq LIMIT ?",
+            (*names, WRITE_QUEUE_BATCH),
+        ).fetchall()
+        if not rows:
+            return False
+        grouped = {}
+        for seq, target, op, key, payload, attempts in rows:
+            ops = grouped.setdefault(target, {"append": [], "patch": []})
+            ops[op].append((seq, key, json.loads(payload), attempts))
+        for name, ops in grouped.items():
+            target = self.targets[name]
+            try:
+                if ops["append"]:
+                    await self._flush_appends(target, ops["append"])
+                if ops["patch"]:
+                    await self._flush_patches(target, ops["patch"])
+            except Exception as e:
+                self._record_failure(ops["append"] + ops["patch"], e)
+                raise
+        return len(rows) == WRITE_QUEUE_BATCH
+
+    async def _flush_appends(self, target, items: list):
+        await self._throttle()
+        response = await sheets.call(
+            target.worksheet.append_rows,
+            [payload for _, _, payload, _ in items],
+            value_input_option=gspread.utils.ValueInputOption.raw,
+        )
+        updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+        match = re.search(r"![A-Z]+(\d+)", updated_range)
+        if match:
+            target.on_appended([key for _, key, _, _ in items], int(match.group(1)))
+        self._delete(items)
+
+    # Номера строк сверяются перед каждой пачкой: в офисе строки вставляют
+    # и сортируют, и старый индекс отправил бы изменение в чужую строку
+    async def _flush_patches(self, target, items: list):
+        await target.refresh_rows()
+        cells = {}
+        for _, key, changes, _ in items:
+            row_number = target.resolve_row(key)
+            if row_number is None:
+                logger.error(f"Строка для записи {key} не найдена, изменение пропущено: {changes}")
+                continue
+            row_cells = cells.setdefault(row_number, {})
+            for column, value in changes.items():
+                row_cells[target.columns[column]] = value
+        if cells:
+            await self._throttle()
+            await sheets.call(
+                target.worksheet.batch_update,
+                build_row_ranges(cells),
+                value_input_option=gspread.utils.ValueInputOption.raw,
+            )
+        self._delete(items)
+
+    def _delete(self, items: list):
+        self.db.executemany("DELETE FROM sheet_writes WHERE seq = ?", [(seq,) for seq, *_ in items])
+        self.db.commit()
+
+    # Записи, которые так и не удалось отправить, откладываем в отдельную таблицу,
+    # чтобы они не блокировали очередь
+    def _record_failure(self, items: list, error: Exception):
+        response = getattr(error, "response", None)
+        if response is not None and getattr(response, "status_code", None) == 429:
+            return
+        seqs = [(seq,) for seq, *_ in items]
+        self.db.executemany("UPDATE sheet_writes SET attempts = attempts + 1 WHERE seq = ?", seqs)
+        dead = [seq for seq, _, _, attempts in items if attempts + 1 >= WRITE_QUEUE_MAX_ATTEMPTS]
+        if dead:
+            marks = ",".join("?" * len(dead))
+            self.db.execute(
+                "INSERT OR REPLACE INTO sheet_writes_failed (seq, target, op, row_key, payload, error) "
+                f"SELECT seq, target, op, row_key, payload, ? FROM sheet_writes WHERE seq IN ({marks})",
+                [str(error), *dead],
+            )
+            self.db.execute(f"DELETE FROM sheet_writes WHERE seq IN ({marks})", dead)
+            logger.error(f"❌ {len(dead)} записей не удалось отправить в таблицу, они сохранены в sheet_writes_failed")
+        self.db.commit()
+
+# Соседние колонки строки склеиваются в один диапазон A1
+def build_row_ranges(pending: dict):
+    data = []
+    for row_number, cells in pending.items():
+        columns = sorted(cells)
+        start = prev = columns[0]
+        values = [cells[start]]
+        for column in columns[1:]:
+            if column == prev + 1:
+                values.append(cells[column])
+            else:
+                data.append(row_range(row_number, start, values))
+                start, values = column, [cells[column]]
+            prev = column
+        data.append(row_range(row_number, start, values))
+    return data
+
+def row_range(row_number: int, start_column: int, values: list):
+    first = gspread.utils.rowcol_to_a1(row_number, start_column)
+    last = gspread.utils.rowcol_to_a1(row_number, start_column + len(values) - 1)
+    return {"range": f"{first}:{last}", "values": [values]}
+
+write_queue = WriteBehindQueue(WRITE_QUEUE_PATH)
+
+# Локальное хранилище служебного состояния бота (диалоги, номера заказов).
+# Файл должен лежать на постоянном диске, иначе деплой его стирает; на Render
+# это диск из render.yaml. Диск есть только у одной копии сервиса, поэтому
+# для нескольких копий бота диалоги нужно держать в Redis (REDIS_URL).
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+state_db = sqlite3.connect(STATE_DB_PATH)
+state_db.execute("PRAGMA journal_mode=WAL")
+
+# Выдача номеров заказов: последний номер хранится в памяти и в state_db,
+# поэтому создание заказа не читает таблицу, а номера не повторяются
+class OrderIdAllocator:
+    def __init__(self, db):
+        self.db = db
+        self.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.db.commit()
+        self.lock = asyncio.Lock()
+        row = self.db.execute("SELECT value FROM counters WHERE name = 'order_id'").fetchone()
+        self.last_id = row[0] if row else 1000
+
+    # Номера, добавленные в таблицу вручную, тоже учитываются
+    def observe(self, max_existing_id):
+        if max_existing_id and max_existing_id > self.last_id:
+            self.last_id = max_existing_id
+            self._save()
+
+    async def next_id(self):
+        async with self.lock:
+            self.last_id += 1
+            self._save()
+            return self.last_id
+
+    def _save(self):
+        self.db.execute(
+            "INSERT INTO counters (name, value) VALUES ('order_id', ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            (self.last_id,),
+        )
+        self.db.commit()
+
+order_ids = OrderIdAllocator(state_db)
+
+# Состояния диалогов (FSM) переживают перезапуск: по умолчанию они лежат
+# в state_db, при REDIS_URL — в Redis, что позволяет запускать несколько
+# копий бота. Брошенный на полпути диалог забывается через FSM_TTL секунд.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # sqlite | memory
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 3600)))
+FSM_PURGE_INTERVAL = 3600
+REDIS_URL = os.getenv("REDIS_URL")
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db, ttl: int):
+        self.db = db
+        self.ttl = ttl
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.db.commit()
+        self.last_purge = 0.0
+        self.purge()
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+            key.business_connection_id or "", key.destiny,
+        ))
+
+    def _load(self, key: StorageKey):
+        row = self.db.execute("SELECT state, data, updated FROM fsm WHERE key = ?", (self._key(key),)).fetchone()
+        if row is None or (self.ttl and time.time() - row[2] > self.ttl):
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def _save(self, key: StorageKey, state, data: dict):
+        if state is None and not data:
+            self.db.execute("DELETE FROM fsm WHERE key = ?", (self._key(key),))
+        else:
+            self.db.execute(
+                "INSERT OR REPLACE INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?)",
+                (self._key(key), state, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+        self.db.commit()
+        if time.time() - self.last_purge > FSM_PURGE_INTERVAL:
+            self.purge()
+
+    def purge(self):
+        self.last_purge = time.time()
+        if self.ttl:
+            removed = self.db.execute("DELETE FROM fsm WHERE updated < ?", (time.time() - self.ttl,)).rowcount
+            self.db.commit()
+            if removed:
+                logger.info(f"🧹 Удалено брошенных диалогов: {removed}")
+
+    async def set_state(self, key: StorageKey, state=None):
+        _, data = self._load(key)
+        self._save(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey):
+        return self._load(key)[0]
+
+    async def set_data(self, key: StorageKey, data: dict):
+        state, _ = self._load(key)
+        self._save(key, state, data)
+
+    async def get_data(self, key: StorageKey):
+        return self._load(key)[1]
+
+    async def close(self):
+        pass
+
+    # Сколько пользователей сейчас посреди каждого диалога
+    def state_counts(self):
+        rows = self.db.execute(
+            "SELECT state, COUNT(*) FROM fsm WHERE state IS NOT NULL AND updated >= ? GROUP BY state",
+            (time.time() - self.ttl if self.ttl else 0,),
+        ).fetchall()
+        return dict(rows)
+
+def create_fsm_storage():
+    if REDIS_URL:
+        from aiogram.fsm.storage.redis import RedisStorage
+        storage = RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL or None, data_ttl=FSM_TTL or None)
+        # Между копиями бота апдейты одного пользователя обрабатываются по очереди
+        return storage, storage.create_isolation()
+    if FSM_STORAGE == "memory":
+        return MemoryStorage(), None
+    return SQLiteStorage(state_db, FSM_TTL), None
+
+fsm_storage, fsm_isolation = create_fsm_storage()
+dp = Dispatcher(storage=fsm_storage, events_isolation=fsm_isolation)
+
+def parse_order_id(value):
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+# Порядок выдачи заказов: сначала срочные, затем по сроку выполнения
+def order_priority_key(record):
+    urgent = str(record.get("Приоритет", "")).strip().lower() == "срочный"
+    return (0 if urgent else 1, parse_deadline(record), record["№ заказа"])
+
+# Срок вводится как "10.04" или "10.04.2026"; год без указания берём из даты создания
+def parse_deadline(record):
+    deadline = str(record.get("Срок", "")).strip()
+    try:
+        return datetime.strptime(deadline, "%d.%m.%Y")
+    except ValueError:
+        pass
+    try:
+        created = datetime.strptime(str(record.get("Дата создания", "")).strip(), "%d.%m.%Y")
+        year = created.year
+    except ValueError:
+        year = datetime.now().year
+    try:
+        return datetime.strptime(f"{deadline}.{year}", "%d.%m.%Y")
+    except ValueError:
+        return datetime.max
+
+# Смена ищется по колонке «ID смены»: отображаемые дата и время могут
+# переформатироваться в листе. У старых строк без ID — прежний ключ
+# «сотрудник|дата|начало».
+def shift_key(employee_id, date, start_time, shift_id=""):
+    return str(shift_id).strip() or f"{employee_id}|{date}|{start_time}"
+
+# Лист Google Sheets как зеркало хранилища: номер строки по ключу записи,
+# изменения уходят через очередь отложенной записи
+def order_row_key(row):
+    order_id = parse_order_id(row[0]) if row else None
+    return None if order_id is None else str(order_id)
+
+def shift_row_key(row):
+    row = list(row) + [""] * (len(SHIFT_HEADERS) - len(row))
+    employee_id = parse_order_id(row[0])
+    return None if employee_id is None else shift_key(employee_id, row[2], row[3], row[7])
+
+class SheetMirror:
+    def __init__(self, name: str, title: str, headers: list, key_of_row, key_range: str):
+        self.name = name
+        self.title = title
+        self.worksheet = None   # появится после подключения к Google
+        self.headers = headers
+        self.columns = {column: i + 1 for i, column in enumerate(headers)}
+        self.key_of_row = key_of_row
+        self.key_range = key_range
+        self.row_by_key = {}
+        self.next_row = 2
+        write_queue.register(name, self)
+
+    # Чтение всего листа; ещё не отправленные изменения накладываются поверх
+    async def read_all(self):
+        async with write_queue.lock:
+            values = await sheets.call(self.worksheet.get_all_values)
+            rows = {}
+            self.row_by_key = {}
+            for row_number, row in enumerate(values[1:], start=2):
+                key = self.key_of_row(row)
+                if key is None:
+                    continue
+                rows[key] = list(row) + [""] * (len(self.headers) - len(row))
+                self.row_by_key[key] = row_number
+            self.next_row = max(len(values), 1) + 1
+            for op, key, payload in write_queue.pending(self.name):
+                if op == "append":
+                    rows[key] = [cell_text(value) for value in payload]
+                    self.row_by_key[key] = self.next_row
+                    self.next_row += 1
+                elif key in rows:
+                    for column, value in payload.items():
+                        rows[key][self.columns[column] - 1] = value
+        return list(rows.values())
+
+    # Дешёвое чтение только ключевых колонок, чтобы сверить номера строк
+    async def refresh_rows(self):
+        values = await sheets.call(self.worksheet.get, self.key_range)
+        row_by_key = {}
+        for row_number, row in enumerate(values[1:], start=2):
+            key = self.key_of_row(row)
+            if key is not None:
+                row_by_key[key] = row_number
+        self.row_by_key = row_by_key
+        self.next_row = max(len(values), 1) + 1
+
+    def resolve_row(self, key):
+        return self.row_by_key.get(key)
+
+    # Google сообщает, куда на самом деле легли строки — уточняем индекс
+    def on_appended(self, keys, first_row: int):
+        for offset, key in enumerate(keys):
+            self.row_by_key[key] = first_row + offset
+        self.next_row = max(self.next_row, first_row + len(keys))
+
+    def append(self, key: str, row: list):
+        self.row_by_key[key] = self.next_row
+        self.next_row += 1
+        write_queue.append(self.name, key, row)
+
+    def patch(self, key: str, changes: dict):
+        write_queue.patch(self.name, key, changes)
+
+# Хранилище данных бота. SQLite — основная база (WAL, индексы по исполнителю
+# и статусу), Google Sheets — зеркало для офиса. STORAGE_BACKEND=sheets
+# оставляет таблицы основным хранилищем, как раньше.
+# С SQLite база (STORAGE_PATH) и очередь записи (WRITE_QUEUE_PATH) обязаны
+# лежать на постоянном диске: ещё не отправленные в таблицу заказы и смены
+# есть только там, и деплой на стираемой файловой системе потеряет их
+# навсегда. На Render это диск из render.yaml; без диска — STORAGE_BACKEND=sheets.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+STORAGE_PATH = os.getenv("STORAGE_PATH", "bot.db")
+
+# Локальные данные, которые не зеркалируются в таблицы заказов и смен:
+# геоточки, чеки и состав команды. Всегда лежат в SQLite, при любом
+# STORAGE_BACKEND; соединение с базой общее с SQLiteBackend.
+class LocalStore:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS locations (
+                employee_id INTEGER NOT NULL, ts REAL NOT NULL, lat REAL NOT NULL, lng REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS locations_employee_ts ON locations (employee_id, ts);
+            CREATE TABLE IF NOT EXISTS latest_positions (
+                employee_id INTEGER PRIMARY KEY, ts REAL NOT NULL, lat REAL NOT NULL, lng REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS receipts (
+                order_id INTEGER PRIMARY KEY, file_id TEXT NOT NULL, saved_at TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS roster (
+                user_id INTEGER PRIMARY KEY, name TEXT NOT NULL, roles TEXT NOT NULL);
+        """)
+        self.db.commit()
+
+    # points: [(ID сотрудника, unix-время, широта, долгота)]
+    def append_locations(self, points: list):
+        self.db.executemany("INSERT INTO locations (employee_id, ts, lat, lng) VALUES (?, ?, ?, ?)", points)
+        self.db.commit()
+
+    def load_latest_positions(self):
+        rows = self.db.execute("SELECT employee_id, ts, lat, lng FROM latest_positions").fetchall()
+        return {employee_id: (ts, lat, lng) for employee_id, ts, lat, lng in rows}
+
+    def save_latest_positions(self, positions: dict):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO latest_positions (employee_id, ts, lat, lng) VALUES (?, ?, ?, ?)",
+            [(employee_id, *position) for employee_id, position in positions.items()],
+        )
+        self.db.commit()
+
+    def save_receipt(self, order_id: int, file_id: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO receipts (order_id, file_id, saved_at) VALUES (?, ?, ?)",
+            (order_id, file_id, datetime.now().isoformat(timespec="seconds")),
+        )
+        self.db.commit()
+
+    def get_receipt(self, order_id: int):
+        found = self.db.execute("SELECT file_id FROM receipts WHERE order_id = ?", (order_id,)).fetchone()
+        return found[0] if found else None
+
+    def load_roster(self):
+        return self.db.execute("SELECT user_id, name, roles FROM roster ORDER BY user_id").fetchall()
+
+    def save_roster_member(self, user_id: int, name: str, roles: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO roster (user_id, name, roles) VALUES (?, ?, ?)", (user_id, name, roles),
+        )
+        self.db.commit()
+
+    def delete_roster_member(self, user_id: int):
+        self.db.execute("DELETE FROM roster WHERE user_id = ?", (user_id,))
+        self.db.commit()
+
+    # Состав из листа целиком заменяет локальную копию
+    def replace_roster(self, rows: list):
+        with self.db:
+            self.db.execute("DELETE FROM roster")
+            self.db.executemany("INSERT INTO roster (user_id, name, roles) VALUES (?, ?, ?)", rows)
+
+# Где живут заказы и смены. Реализации обязаны уметь загрузить, дописать
+# и изменить строку; остальное — необязательные хуки.
+class StorageBackend(ABC):
+    # Нужно ли перечитывать кэши при периодической сверке
+    reload_on_resync = False
+
+    # Нужны ли таблицы Google, чтобы прогреть кэши
+    def needs_sheets(self):
+        return False
+
+    async def prepare(self):
+        pass
+
+    async def refresh(self):
+        pass
+
+    @abstractmethod
+    async def load_orders(self):
+        ...
+
+    @abstractmethod
+    def append_order(self, row: list):
+        ...
+
+    @abstractmethod
+    def patch_order(self, order_id: int, changes: dict):
+        ...
+
+    @abstractmethod
+    async def load_shifts(self):
+        ...
+
+    @abstractmethod
+    def append_shift(self, key: str, row: list):
+        ...
+
+    @abstractmethod
+    def patch_shift(self, key: str, changes: dict):
+        ...
+
+class SQLiteBackend(StorageBackend):
+    # Таблицы заказов и смен лежат в той же базе, что и LocalStore
+    def __init__(self, db: sqlite3.Connection, orders_mirror: SheetMirror = None, shifts_mirror: SheetMirror = None):
+        self.db = db
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, row_key TEXT NOT NULL UNIQUE,
+                owner TEXT, status TEXT, data TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS orders_owner_status ON orders (owner, status);
+            CREATE TABLE IF NOT EXISTS shifts (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, row_key TEXT NOT NULL UNIQUE,
+                owner TEXT, status TEXT, data TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS shifts_owner_status ON shifts (owner, status);
+        """)
+        self.db.commit()
+        self.mirrors = {"orders": orders_mirror, "shifts": shifts_mirror}
+
+    # Таблицы заказов и смен устроены одинаково: ключ строки, владелец, статус и
+    # значения колонок в JSON
+    TABLES = {
+        "orders": (ORDER_HEADERS, "Ответственный", order_row_key),
+        "shifts": (SHIFT_HEADERS, "ID сотрудника", shift_row_key),
+    }
+
+    def _empty(self, table: str):
+        return self.db.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+
+    # Первый запуск: данные нужно перенести из Google Sheets
+    def needs_sheets(self):
+        return any(mirror is not None and self._empty(table) for table, mirror in self.mirrors.items())
+
+    async def prepare(self):
+        for table, mirror in self.mirrors.items():
+            if mirror is None or not self._empty(table):
+                continue
+            rows = await mirror.read_all()
+            for row in rows:
+                self._insert(table, row)
+            self.db.commit()
+            logger.info(f"📥 Импортировано из Google Sheets в {table}: {len(rows)}")
+
+    async def _load(self, table: str):
+        return [json.loads(data) for (data,) in self.db.execute(f"SELECT data FROM {table} ORDER BY seq")]
+
+    def _insert(self, table: str, row: list):
+        headers, owner_column, key_of_row = self.TABLES[table]
+        row = [cell_text(value) for value in row] + [""] * (len(headers) - len(row))
+        self.db.execute(
+            f"INSERT OR REPLACE INTO {table} (row_key, owner, status, data) VALUES (?, ?, ?, ?)",
+            (key_of_row(row), row[headers.index(owner_column)], row[headers.index("Статус")],
+             json.dumps(row, ensure_ascii=False)),
+        )
+
+    def _append(self, table: str, row: list):
+        self._insert(table, row)
+        self.db.commit()
+        if self.mirrors[table] is not None:
+            self.mirrors[table].append(self.TABLES[table][2](row), row)
+
+    def _patch(self, table: str, key: str, changes: dict):
+        headers = self.TABLES[table][0]
+        found = self.db.execute(f"SELECT data FROM {table} WHERE row_key = ?", (key,)).fetchone()
+        if found is None:
+            return
+        row = json.loads(found[0])
+        row += [""] * (len(headers) - len(row))
+        for column, value in changes.items():
+            row[headers.index(column)] = cell_text(value)
+        owner_column = self.TABLES[table][1]
+        self.db.execute(
+            f"UPDATE {table} SET owner = ?, status = ?, data = ? WHERE row_key = ?",
+            (row[headers.index(owner_column)], row[headers.index("Статус")],
+             json.dumps(row, ensure_ascii=False), key),
+        )
+        self.db.commit()
+        if self.mirrors[table] is not None:
+            self.mirrors[table].patch(key, changes)
+
+    async def load_orders(self):
+        return await self._load("orders")
+
+    def append_order(self, row: list):
+        self._append("orders", row)
+
+    def patch_order(self, order_id: int, changes: dict):
+        self._patch("orders", str(order_id), changes)
+
+    async def load_shifts(self):
+        return await self._load("shifts")
+
+    def append_shift(self, key: str, row: list):
+        self._append("shifts", row)
+
+    def patch_shift(self, key: str, changes: dict):
+        self._patch("shifts", key, changes)
+
+    # Подтягиваем номера строк зеркала после ручных правок листа
+    async def refresh(self):
+        for mirror in self.mirrors.values():
+            if mirror is not None and mirror.worksheet is not None:
+                await mirror.refresh_rows()
+
+# Заказы и смены живут в Google Sheets, как до появления SQLite;
+# геоточки, чеки и состав всё равно хранятся локально (LocalStore)
+class SheetsBackend(StorageBackend):
+    reload_on_resync = True
+
+    def __init__(self, orders_mirror: SheetMirror, shifts_mirror: SheetMirror):
+        self.mirrors = {"orders": orders_mirror, "shifts": shifts_mirror}
+
+    def needs_sheets(self):
+        return True
+
+    async def load_orders(self):
+        return await self.mirrors["orders"].read_all()
+
+    def append_order(self, row: list):
+        self.mirrors["orders"].append(order_row_key(row), row)
+
+    def patch_order(self, order_id: int, changes: dict):
+        self.mirrors["orders"].patch(str(order_id), changes)
+
+    async def load_shifts(self):
+        return await self.mirrors["shifts"].read_all()
+
+    def append_shift(self, key: str, row: list):
+        self.mirrors["shifts"].append(key, row)
+
+    def patch_shift(self, key: str, changes: dict):
+        self.mirrors["shifts"].patch(key, changes)
+
+if SHEETS_MODE == "off":
+    orders_mirror = shifts_mirror = None
+else:
+    orders_mirror = SheetMirror("orders", "Заказы на участки", ORDER_HEADERS, order_row_key, "A:A")
+    shifts_mirror = SheetMirror("shifts", "Учёт смен", SHIFT_HEADERS, shift_row_key, "A:H")
+
+local_store = LocalStore(STORAGE_PATH)
+if STORAGE_BACKEND == "sheets":
+    if orders_mirror is None:
+        raise Exception("❌ STORAGE_BACKEND=sheets требует SHEETS_MODE=google или fake.")
+    storage = SheetsBackend(orders_mirror, shifts_mirror)
+else:
+    storage = SQLiteBackend(local_store.db, orders_mirror, shifts_mirror)
+
+# Состав команды: Telegram ID → имя и роли (admin — администратор, worker —
+# исполнитель заказов). Рабочая копия — в SQLite, долговременная — в листе
+# «Сотрудники» (ID сотрудника | Имя | Роли): правки /team записываются в лист,
+# а если база пуста (новый деплой без диска), состав восстанавливается из листа.
+# При ROSTER_SOURCE=sheet лист — источник, и его ручные правки подхватываются
+# без перезапуска: /team reload или раз в ROSTER_RELOAD_INTERVAL секунд.
+ROSTER_SOURCE = os.getenv("ROSTER_SOURCE", "storage")
+ROSTER_SHEET = os.getenv("ROSTER_SHEET", "Сотрудники")
+ROSTER_HEADERS = ["ID сотрудника", "Имя", "Роли"]
+ROSTER_RELOAD_INTERVAL = float(os.getenv("ROSTER_RELOAD_INTERVAL", "60"))
+ROSTER_ROLE_ALIASES = {
+    "admin": "admin", "админ": "admin", "администратор": "admin",
+    "worker": "worker", "сотрудник": "worker", "исполнитель": "worker",
+}
+
+# «admin, worker» или «администратор; сотрудник»; пусто — исполнитель
+def parse_roles(value) -> set:
+    roles = set()
+    for part in str(value).replace(";", ",").split(","):
+        part = part.strip().lower()
+        if not part:
+            continue
+        if part not in ROSTER_ROLE_ALIASES:
+            raise ValueError(f"Неизвестная роль «{part}», допустимы admin и worker")
+        roles.add(ROSTER_ROLE_ALIASES[part])
+    return roles or {"worker"}
+
+def format_roles(roles) -> str:
+    return ",".join(sorted(roles))
+
+class Roster:
+    def __init__(self, store: LocalStore):
+        self.store = store
+        self.members = {}    # Telegram ID → {"id", "name", "roles"}
+        self.by_name = {}    # имя → Telegram ID
+        self.admins = []     # ID администраторов — для рассылок
+        self.worksheet = None
+        self.dirty = False   # правки ещё не записаны в лист
+        self.seeded = False  # состав заполнен начальным списком и ещё не сверен с листом
+
+    @staticmethod
+    def _to_members(rows):
+        return {
+            user_id: {"id": user_id, "name": name, "roles": parse_roles(roles) if isinstance(roles, str) else set(roles)}
+            for user_id, name, roles in rows
+        }
+
+    @staticmethod
+    def _check(members):
+        if not any("admin" in member["roles"] for member in members.values()):
+            raise ValueError("В составе должен остаться хотя бы один администратор")
+
+    def _set(self, members: dict) -> bool:
+        if members == self.members:
+            return False
+        self.members = members
+        self.by_name = {member["name"]: user_id for user_id, member in members.items()}
+        self.admins = [user_id for user_id, member in members.items() if "admin" in member["roles"]]
+        return True
+
+    # Пустой состав заполняется прежним списком сотрудников и ADMIN_IDS
+    def load(self) -> bool:
+        rows = self.store.load_roster()
+        if not rows:
+            members = self._to_members((user_id, name, {"worker"}) for user_id, name in ROSTER_DEFAULT.items())
+            for user_id in BOOTSTRAP_ADMIN_IDS:
+                member = members.setdefault(
+                    user_id, {"id": user_id, "name": f"Администратор {user_id}", "roles": set()},
+                )
+                member["roles"].add("admin")
+            rows = [(user_id, member["name"], format_roles(member["roles"])) for user_id, member in members.items()]
+            self.store.replace_roster(rows)
+            self.seeded = SHEETS_MODE != "off"
+            logger.info(f"👥 Состав команды заполнен начальным списком: {len(rows)} чел.")
+        return self._set(self._to_members(rows))
+
+    # Состав применяется только целиком: любая неверная строка (ID, роль,
+    # повтор ID или имени) или лист без администраторов — ValueError, и
+    # текущий состав остаётся. Пустой лист тоже ничего не меняет.
+    def _open_sheet(self):
+        if self.worksheet is None:
+            self.worksheet = open_worksheet(ROSTER_SHEET, ROSTER_HEADERS)
+        return self.worksheet
+
+    async def load_sheet(self) -> bool:
+        values = await sheets.call(lambda: self._open_sheet().get_all_values())
+        rows, ids, names = [], set(), {}
+        for line, row in enumerate(values[1:], start=2):
+            row = [str(cell).strip() for cell in row] + [""] * (len(ROSTER_HEADERS) - len(row))
+            if not any(row):
+                continue
+            user_id = parse_order_id(row[0])
+            name = row[1] or row[0]
+            try:
+                if user_id is None:
+                    raise ValueError(f"неверный ID «{row[0]}»")
+                if user_id in ids:
+                    raise ValueError(f"ID {user_id} повторяется")
+                if name in names:
+                    raise ValueError(f"имя «{name}» уже занято сотрудником {names[name]}")
+                roles = parse_roles(row[2])
+            except ValueError as e:
+                raise ValueError(f"Лист «{ROSTER_SHEET}», строка {line}: {e}. Состав не обновлён") from None
+            ids.add(user_id)
+            names[name] = user_id
+            rows.append((user_id, name, roles))
+        if not rows:
+            logger.warning(f"⚠️ Лист «{ROSTER_SHEET}» пуст, записываем в него текущий состав")
+            self.seeded = False
+            self.dirty = True
+            return False
+        members = self._to_members(rows)
+        try:
+            self._check(members)
+        except ValueError as e:
+            raise ValueError(f"Лист «{ROSTER_SHEET}»: {e}. Состав не обновлён") from None
+        self.seeded = False
+        if members == self.members:
+            return False
+        self.store.replace_roster(
+            [(user_id, member["name"], format_roles(member["roles"])) for user_id, member in members.items()]
+        )
+        return self._set(members)
+
+    # Лист переписывается целиком: состав небольшой, а удалённые строки
+    # так не остаются в листе
+    async def save_sheet(self):
+        values = [ROSTER_HEADERS] + [
+            [user_id, member["name"], format_roles(member["roles"])] for user_id, member in self.members.items()
+        ]
+        def write():
+            worksheet = self._open_sheet()
+            height = len(worksheet.get_all_values())
+            rows = values + [[""] * len(ROSTER_HEADERS)] * (height - len(values))
+            worksheet.batch_update(
+                [row_range(row_number, 1, row) for row_number, row in enumerate(rows, start=1)],
+                value_input_option=gspread.utils.ValueInputOption.raw,
+            )
+        self.dirty = False
+        try:
+            await sheets.call(write)
+        except Exception:
+            self.dirty = True
+            raise
+
+    def get(self, user_id):
+        return self.members.get(user_id)
+
+    def name_of(self, user_id, default=None):
+        member = self.members.get(user_id)
+        return member["name"] if member else default
+
+    def id_of(self, name):
+        return self.by_name.get(str(name).strip())
+
+    def has_role(self, user_id, role: str) -> bool:
+        member = self.members.get(user_id)
+        return member is not None and role in member["roles"]
+
+    def is_admin(self, user_id) -> bool:
+        return self.has_role(user_id, "admin")
+
+    def is_worker(self, user_id) -> bool:
+        return self.has_role(user_id, "worker")
+
+    def admin_ids(self):
+        return self.admins
+
+    # [(Telegram ID, имя)] исполнителей
+    def workers(self):
+        return [(user_id, member["name"]) for user_id, member in self.members.items() if "worker" in member["roles"]]
+
+    def upsert(self, user_id: int, name: str, roles: set):
+        name = name.strip()
+        owner = self.by_name.get(name)
+        if owner is not None and owner != user_id:
+            raise ValueError(f"Имя «{name}» уже занято сотрудником {owner}")
+        members = {**self.members, user_id: {"id": user_id, "name": name, "roles": set(roles)}}
+        self._check(members)
+        self.store.save_roster_member(user_id, name, format_roles(roles))
+        self.dirty = SHEETS_MODE != "off"
+        return self._set(members)
+
+    def remove(self, user_id: int) -> bool:
+        if user_id not in self.members:
+            return False
+        members = {uid: member for uid, member in self.members.items() if uid != user_id}
+        self._check(members)
+        self.store.delete_roster_member(user_id)
+        self.dirty = SHEETS_MODE != "off"
+        return self._set(members)
+
+roster = Roster(local_store)
+
+# Рассылка событий открытым панелям WebApp (Server-Sent Events).
+# У каждого клиента своя ограниченная очередь: если телефон не успевает
+# читать и очередь переполнилась, клиент отключается и после
+# переподключения догружает пропущенное через /api/orders/changes.
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+
+class EventHub:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.clients = {}   # очередь клиента → исполнитель (None — все события)
+
+    def subscribe(self, assignee=None):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.clients[queue] = assignee
+        return queue
+
+    def unsubscribe(self, queue):
+        self.clients.pop(queue, None)
+
+    # Сообщение кодируется один раз и раскладывается по очередям без ожидания
+    def publish(self, event: str, data, assignee=None, event_id=None):
+        if not self.clients:
+            return
+        message = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        if event_id is not None:
+            message = f"id: {event_id}\n{message}"
+        message = message.encode()
+        for queue, wanted in list(self.clients.items()):
+            if wanted is not None and assignee is not None and wanted != assignee:
+                continue
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                logger.warning("⚠️ Клиент событий не успевает читать, отключаем")
+                self.unsubscribe(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def close(self):
+        for queue in list(self.clients):
+            self.unsubscribe(queue)
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+events = EventHub(EVENTS_QUEUE_SIZE)
+
+# Очередь исходящих сообщений Telegram. Обработчики только ставят сообщение
+# в очередь, несколько воркеров отправляют параллельно, соблюдая общий лимит
+# бота и паузу между сообщениями в один чат. SOS идёт раньше всего остального.
+# Информационные уведомления администраторам (начало работы, приход и уход
+# с объекта) идут с PRIORITY_BULK: они уступают остальным и отбрасываются,
+# если очередь выросла до OUTBOX_BULK_LIMIT.
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))   # сообщений в секунду
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", "1"))  # секунд между сообщениями в чат
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BULK_LIMIT = int(os.getenv("OUTBOX_BULK_LIMIT", "10000"))
+
+class Outbox:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue()
+        self.seq = 0
+        self.chat_ready = {}    # chat_id → когда в этот чат снова можно писать
+        self.global_ready = 0.0
+
+    # method — метод Bot: "send_message", "send_photo" и т.д.
+    def submit(self, chat_id: int, method: str = "send_message", priority: int = PRIORITY_NORMAL, **kwargs):
+        if priority >= PRIORITY_BULK and self.queue.qsize() >= OUTBOX_BULK_LIMIT:
+            logger.warning(f"⚠️ Очередь сообщений переполнена, пропускаем сообщение в {chat_id}")
+            return
+        self.seq += 1
+        self.queue.put_nowait((priority, self.seq, chat_id, method, kwargs, 1))
+
+    def send(self, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        self.submit(chat_id, "send_message", priority, text=text, **kwargs)
+
+    def broadcast(self, chat_ids, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        for chat_id in chat_ids:
+            self.send(chat_id, text, priority, **kwargs)
+
+    def _later(self, delay: float, item):
+        asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, item)
+
+    # Общий лимит: слоты раздаются по очереди с интервалом 1 / OUTBOX_GLOBAL_RATE
+    async def _global_slot(self):
+        now = time.monotonic()
+        slot = max(now, self.global_ready)
+        self.global_ready = slot + 1 / OUTBOX_GLOBAL_RATE
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            priority, seq, chat_id, method, kwargs, attempt = item
+            # Чат ещё занят — сообщение вернётся в очередь позже, воркер не ждёт
+            wait = self.chat_ready.get(chat_id, 0) - time.monotonic()
+            if wait > 0:
+                self._later(wait, item)
+                continue
+            self.chat_ready[chat_id] = time.monotonic() + OUTBOX_CHAT_INTERVAL
+            await self._global_slot()
+            try:
+                await getattr(bot, method)(chat_id, **kwargs)
+            except TelegramRetryAfter as e:
+                logger.warning(f"⏳ Telegram просит подождать {e.retry_after} с перед отправкой в {chat_id}")
+                self.chat_ready[chat_id] = time.monotonic() + e.retry_after
+                self._later(e.retry_after, item)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= OUTBOX_MAX_ATTEMPTS:
+                    logger.error(f"Не удалось отправить сообщение в {chat_id} после {attempt} попыток: {e}")
+                else:
+                    self._later(min(60, 2 ** attempt), (priority, seq, chat_id, method, kwargs, attempt + 1))
+            except Exception as e:
+                logger.error(f"Не удалось отправить сообщение в {chat_id}: {e}")
+
+    async def run(self):
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+outbox = Outbox(OUTBOX_WORKERS)
+
+# Расстояние между точками в метрах (гаверсинус)
+def distance_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+# «55.75, 37.61» из колонки «Координаты» → (широта, долгота)
+def parse_coordinates(value):
+    parts = re.split(r"[,;\s]+", str(value).strip())
+    if len(parts) != 2:
+        return None
+    try:
+        lat, lng = float(parts[0]), float(parts[1])
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+# Сеточный индекс открытых заказов по координатам. Ячейка около километра,
+# поиск ближайших идёт кольцами ячеек от точки сотрудника и
+# останавливается, как только дальние кольца уже не могут дать ближе.
+GEO_CELL_DEG = float(os.getenv("GEO_CELL_DEG", "0.01"))
+GEO_MAX_RINGS = int(os.getenv("GEO_MAX_RINGS", "50"))
+CLOSED_STATUSES = ("Выполнен", "Отменён")
+# Автомат статусов заказа: куда можно перейти из каждого статуса. Закрытый
+# заказ не переоткрывается; незнакомый статус (правка в таблице) считается новым.
+ORDER_NEW_STATUS = "Назначен, не начат"
+ORDER_TRANSITIONS = {
+    ORDER_NEW_STATUS: ("В работе", "Выполнен", "Отменён"),
+    "В работе": ("Выполнен", "Отменён"),
+    "Выполнен": (),
+    "Отменён": (),
+}
+# Колонки, от которых зависит переход статуса; по ним считается версия заказа
+ORDER_VERSION_COLUMNS = ("Статус", "Ответственный", "ID исполнителя")
+# Если у сотрудника столько не начатых заказов или меньше, проще перебрать их
+GEO_SCAN_LIMIT = int(os.getenv("GEO_SCAN_LIMIT", "64"))
+
+class GeoGridIndex:
+    def __init__(self, cell_deg: float):
+        self.cell_deg = cell_deg
+        self.cells = {}      # (строка, столбец) → множество № заказов
+        self.positions = {}  # № заказа → (широта, долгота)
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def add(self, order_id, lat, lng):
+        self.remove(order_id)
+        self.positions[order_id] = (lat, lng)
+        self.cells.setdefault(self._cell(lat, lng), set()).add(order_id)
+
+    def remove(self, order_id):
+        position = self.positions.pop(order_id, None)
+        if position is None:
+            return
+        cell = self._cell(*position)
+        ids = self.cells.get(cell)
+        if ids:
+            ids.discard(order_id)
+            if not ids:
+                del self.cells[cell]
+
+    def clear(self):
+        self.cells = {}
+        self.positions = {}
+
+    # До limit ближайших заказов, прошедших фильтр accept: [(метры, № заказа)]
+    def nearest(self, lat, lng, limit=5, accept=None):
+        row, col = self._cell(lat, lng)
+        # Наименьший размер ячейки в метрах: долгота сжимается к полюсам
+        cell_m = self.cell_deg * 111320 * max(math.cos(math.radians(abs(lat) + self.cell_deg)), 0.01)
+        found = []
+        for ring in range(GEO_MAX_RINGS + 1):
+            for cell in self._ring(row, col, ring):
+                for order_id in self.cells.get(cell, ()):
+                    if accept is None or accept(order_id):
+                        found.append((distance_m(lat, lng, *self.positions[order_id]), order_id))
+            if len(found) >= limit:
+                found.sort()
+                # Всё, что за этим кольцом, не ближе ring * cell_m
+                if found[limit - 1][0] <= ring * cell_m:
+                    return found[:limit]
+        # Дальше колец — полный перебор: так бывает только на пустой карте
+        found = [
+            (distance_m(lat, lng, *position), order_id)
+            for order_id, position in self.positions.items()
+            if accept is None or accept(order_id)
+        ]
+        found.sort()
+        return found[:limit]
+
+    @staticmethod
+    def _ring(row, col, ring):
+        if ring == 0:
+            yield row, col
+            return
+        for d in range(-ring, ring + 1):
+            yield row - ring, col + d
+            yield row + ring, col + d
+        for d in range(-ring + 1, ring):
+            yield row + d, col - ring
+            yield row + d, col + ring
+
+# Сводные отчёты. Вместо перебора всей истории держим накопительные итоги:
+# выполненные заказы — по (день, исполнитель, тип работы, оплата, препарат),
+# закрытые смены — по (день, сотрудник). Каждое изменение заказа или смены
+# снимает старый вклад записи и добавляет новый, так что отчёт строится
+# по числу сочетаний, а не по числу строк в таблице.
+ORDER_ROLLUP_DIMENSIONS = ("day", "employee", "work_type", "payment", "chemical")
+ORDER_ROLLUP_FIELDS = ("orders", "revenue", "area", "quantity")
+SHIFT_ROLLUP_DIMENSIONS = ("day", "employee")
+SHIFT_ROLLUP_FIELDS = ("shifts", "hours")
+REPORT_PERIODS = {
+    "day": lambda day: day.isoformat(),
+    "week": lambda day: "{}-W{:02d}".format(*day.isocalendar()[:2]),
+    "month": lambda day: day.strftime("%Y-%m"),
+}
+
+# "1 500 руб." → 1500.0, "2,5" → 2.5; пусто и текст без чисел — 0
+def parse_number(value):
+    match = re.search(r"-?\d+(?:[.,]\d+)?", str(value).replace(" ", ""))
+    return float(match.group().replace(",", ".")) if match else 0.0
+
+# Вклад заказа в отчёты: (ключ, значения) или None, если он не выполнен
+def order_contribution(record):
+    if record["Статус"] != "Выполнен":
+        return None
+    day = parse_date(str(record["Выполнил работу"]).split(" ")[0]) or \
+        parse_date(str(record["Дата создания"]).split(" ")[0])
+    if day is None:
+        return None
+    key = (day, record["Ответственный"], record["Тип работы"], record["Способ оплаты"], record["Препарат"])
+    return key, (1, parse_number(record["Сумма"]), parse_number(record["Площадь"]), parse_number(record["Количество"]))
+
+def shift_contribution(record):
+    if record["Статус"] != "Завершена":
+        return None
+    day = parse_date(record["Дата"])
+    if day is None:
+        return None
+    return (day, record["Имя сотрудника"]), (1, parse_number(record["Отработано (ч)"]))
+
+# Итоги разложены по дням: день → {остальные измерения → итоги}. Дни с
+# вкладами лежат в отсортированном списке, так что отчёт за период берёт
+# срез этого списка, а не перебирает всю историю.
+class ReportRollups:
+    def __init__(self):
+        self.orders = {}  # день → {ORDER_ROLLUP_DIMENSIONS[1:] → [заказов, выручка, площадь, количество]}
+        self.shifts = {}  # день → {SHIFT_ROLLUP_DIMENSIONS[1:] → [смен, часов]}
+        self.days = {"orders": [], "shifts": []}
+
+    def clear(self, kind):
+        setattr(self, kind, {})
+        self.days[kind] = []
+
+    def _apply(self, kind, contribution, sign):
+        if contribution is None:
+            return
+        (day, *rest), values = contribution
+        table = getattr(self, kind)
+        bucket = table.get(day)
+        if bucket is None:
+            bucket = table[day] = {}
+            bisect.insort(self.days[kind], day)
+        totals = bucket.setdefault(tuple(rest), [0] * len(values))
+        for i, value in enumerate(values):
+            totals[i] += sign * value
+        # Первое поле — количество записей; ноль значит, что вкладов не осталось
+        if totals[0] == 0:
+            del bucket[tuple(rest)]
+            if not bucket:
+                del table[day]
+                days = self.days[kind]
+                del days[bisect.bisect_left(days, day)]
+
+    def update_order(self, before, after):
+        if before != after:
+            self._apply("orders", before, -1)
+            self._apply("orders", after, 1)
+
+    def update_shift(self, before, after):
+        if before != after:
+            self._apply("shifts", before, -1)
+            self._apply("shifts", after, 1)
+
+    # kind — "orders" или "shifts"; group — период (day/week/month) или измерение
+    def query(self, kind, group, date_from=None, date_to=None):
+        if kind == "orders":
+            table, dimensions, fields = self.orders, ORDER_ROLLUP_DIMENSIONS, ORDER_ROLLUP_FIELDS
+        else:
+            table, dimensions, fields = self.shifts, SHIFT_ROLLUP_DIMENSIONS, SHIFT_ROLLUP_FIELDS
+        if group not in REPORT_PERIODS and group not in dimensions:
+            raise ValueError(f"Нельзя сгруппировать {kind} по {group}")
+        days = self.days[kind]
+        lo = bisect.bisect_left(days, date_from) if date_from else 0
+        hi = bisect.bisect_right(days, date_to) if date_to else len(days)
+        result = {}
+        for day in days[lo:hi]:
+            period = REPORT_PERIODS[group](day) if group in REPORT_PERIODS else None
+            for rest, values in table[day].items():
+                label = period if period is not None else rest[dimensions.index(group) - 1]
+                totals = result.setdefault(label, [0] * len(values))
+                for i, value in enumerate(values):
+                    totals[i] += value
+        return [
+            {group: label, **{field: round(value, 2) for field, value in zip(fields, totals)}}
+            for label, totals in sorted(result.items(), key=lambda item: str(item[0]))
+        ]
+
+reports = ReportRollups()
+
+# Кэш заказов: строки в памяти + индекс по исполнителю и статусу.
+# Чтение идёт только из памяти, изменения сразу уходят в хранилище.
+ORDERS_RESYNC_INTERVAL = int(os.getenv("ORDERS_RESYNC_INTERVAL", "300"))
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "100"))
+ORDERS_PAGE_MAX = int(os.getenv("ORDERS_PAGE_MAX", "500"))
+ORDERS_RESPONSE_CACHE = int(os.getenv("ORDERS_RESPONSE_CACHE", "128"))
+ORDERS_CHANGELOG_SIZE = int(os.getenv("ORDERS_CHANGELOG_SIZE", "10000"))
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+
+# Исходы смены статуса: applied — записано; unchanged — заказ уже в этом
+# статусе; repeated — запрос с этим ключом уже был; conflict — переход
+# запрещён или версия устарела; not_found — заказа нет
+class IdempotencyCache:
+    def __init__(self, ttl: int, max_keys: int):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.entries = OrderedDict()   # ключ → (время, исход первого запроса)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def put(self, key, outcome: str):
+        self.entries[key] = (time.monotonic(), outcome)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+
+# Заказ в том виде, в каком его отдаёт /api/orders
+def order_to_api(record):
+    owner = OrdersRepository.owner_of(record)
+    return {
+        "id": record.get('№ заказа', ''),
+        "address": record.get('Адрес', ''),
+        "work_type": record.get('Тип работы', ''),
+        "deadline": record.get('Срок', ''),
+        "status": record.get('Статус', ''),
+        "assignee": record.get('Ответственный', ''),
+        "assignee_id": owner if isinstance(owner, int) else None,
+        "priority": record.get('Приоритет', 'Обычный'),
+        "coordinates": record.get('Координаты', ''),
+        "arrived_at": record.get('Прибыл на объект', ''),
+        "left_at": record.get('Покинул объект', '')
+    }
+
+def parse_date(value):
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(str(value).strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+class OrdersRepository:
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+        self.records = {}     # № заказа → словарь {колонка: значение}
+        self.by_assignee = {} # исполнитель → {Статус: множество № заказов}
+        self.owners = {}      # № заказа → исполнитель (Telegram ID или имя не из состава)
+        self.sorted_ids = []  # № заказов по возрастанию — для постраничной выдачи
+        self.geo = GeoGridIndex(GEO_CELL_DEG)  # открытые заказы с координатами
+        self.version = 0      # растёт при каждом изменении, из него строится ETag
+        # Журнал изменений (версия, № заказа) для дельта-синхронизации WebApp.
+        # Эпоха меняется при перезапуске — клиент с чужой эпохой загружает всё заново.
+        self.epoch = f"{int(time.time()):x}"
+        self.changelog = deque(maxlen=ORDERS_CHANGELOG_SIZE)
+        self.changelog_floor = 0   # изменения до этой версии уже вытеснены из журнала
+        self.fragments = {}   # № заказа → готовый JSON заказа для API
+        self.order_versions = {}  # № заказа → версия заказа (хеш статуса и исполнителя), см. version_of
+        self.idempotency = IdempotencyCache(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_KEYS)
+        self.responses = {}   # параметры запроса → (ETag, тело ответа) текущей версии
+
+    async def load(self):
+        rows = await self.backend.load_orders()
+        records = {}
+        for row in rows:
+            record = self._to_record(row)
+            if record["№ заказа"] is not None:
+                records[record["№ заказа"]] = record
+        # В журнал попадают только заказы, которые изменились с прошлой загрузки
+        changed = [order_id for order_id, record in records.items() if self.records.get(order_id) != record]
+        changed += [order_id for order_id in self.records if order_id not in records]
+        self.records = records
+        self.by_assignee = {}
+        self.owners = {}
+        self.geo.clear()
+        reports.clear("orders")
+        for record in records.values():
+            self._index(record)
+            reports.update_order(None, order_contribution(record))
+        self.sorted_ids = sorted(records)
+        self._touch(changed)
+        if changed:
+            # Изменений после сверки может быть много — клиенты сами догрузят дельту
+            events.publish("orders_changed", {"version": self.version}, event_id=self.version)
+        order_ids.observe(max(records, default=None))
+        logger.info(f"📦 Загружено заказов в кэш: {len(records)}")
+
+    def _to_record(self, row):
+        record = dict(zip(ORDER_HEADERS, list(row) + [""] * (len(ORDER_HEADERS) - len(row))))
+        record["№ заказа"] = parse_order_id(record["№ заказа"])
+        return record
+
+    # Ключ индексов по исполнителю — Telegram ID из колонки «ID исполнителя»;
+    # у старых заказов без неё ID ищется по имени в составе команды, заказ на
+    # человека не из состава остаётся под именем
+    @staticmethod
+    def owner_of(record):
+        owner = parse_order_id(record.get("ID исполнителя", ""))
+        if owner is not None:
+            return owner
+        return roster.id_of(record.get("Ответственный", "")) or record.get("Ответственный", "")
+
+    def _index(self, record):
+        owner = self.owners[record["№ заказа"]] = self.owner_of(record)
+        statuses = self.by_assignee.setdefault(owner, {})
+        statuses.setdefault(record["Статус"], set()).add(record["№ заказа"])
+        position = parse_coordinates(record["Координаты"])
+        if position is not None and record["Статус"] not in CLOSED_STATUSES:
+            self.geo.add(record["№ заказа"], *position)
+
+    def _unindex(self, record):
+        ids = self.by_assignee.get(self.owners.get(record["№ заказа"]), {}).get(record["Статус"])
+        if ids:
+            ids.discard(record["№ заказа"])
+        self.geo.remove(record["№ заказа"])
+
+    # Любое изменение сбрасывает готовые ответы и пишется в журнал;
+    # JSON остальных заказов остаётся
+    def _touch(self, changed):
+        self.version += 1
+        self.responses.clear()
+        for order_id in changed:
+            self.fragments.pop(order_id, None)
+            self.order_versions.pop(order_id, None)
+            if len(self.changelog) == self.changelog.maxlen:
+                self.changelog_floor = self.changelog[0][0]
+            self.changelog.append((self.version, order_id))
+
+    # Версия заказа для проверки compare-and-set — хеш полей, от которых
+    # зависит переход: статуса и исполнителя. Отметки прибытия, комментарии
+    # и сверка с таблицей её не меняют, поэтому офлайн действие не получает
+    # ложный конфликт. Версия не сбрасывается при перезапуске.
+    def version_of(self, order_id):
+        version = self.order_versions.get(order_id)
+        if version is None and order_id in self.records:
+            record = self.records[order_id]
+            content = json.dumps([str(record.get(column, "")) for column in ORDER_VERSION_COLUMNS], ensure_ascii=False)
+            version = self.order_versions[order_id] = hashlib.sha1(content.encode()).hexdigest()[:12]
+        return version
+
+    # version — курсор журнала изменений, версия самого заказа — внутри order
+    def _publish(self, record):
+        order_id = record["№ заказа"]
+        events.publish(
+            "order", {"order": {**order_to_api(record), "version": self.version_of(order_id)}, "version": self.version},
+            self.owners.get(order_id), event_id=self.version,
+        )
+
+    # После смены состава заказы, записанные только по имени, могут
+    # перейти к другому ключу
+    def reindex_owners(self):
+        changed = [
+            order_id for order_id, record in self.records.items()
+            if self.owners.get(order_id) != self.owner_of(record)
+        ]
+        for order_id in changed:
+            record = self.records[order_id]
+            self._unindex(record)
+            self._index(record)
+        if changed:
+            self._touch(changed)
+            events.publish("orders_changed", {"version": self.version}, event_id=self.version)
+        return len(changed)
+
+    def get(self, order_id):
+        return self.records.get(parse_order_id(order_id))
+
+    # Словарь хранит заказы в порядке добавления
+    def all(self):
+        return list(self.records.values())
+
+    # Незакрытые (не выполненные и не отменённые) заказы сотрудника в порядке выдачи
+    def active_for(self, assignee):
+        ids = [
+            order_id
+            for status, order_ids in self.by_assignee.get(assignee, {}).items()
+            if status not in CLOSED_STATUSES
+            for order_id in order_ids
+        ]
+        return sorted((self.records[order_id] for order_id in ids), key=order_priority_key)
+
+    # Следующий ещё не начатый заказ сотрудника
+    def next_for(self, assignee):
+        ids = self.by_assignee.get(assignee, {}).get("Назначен, не начат", ())
+        return min((self.records[order_id] for order_id in ids), key=order_priority_key, default=None)
+
+    # Ближайшие к точке открытые заказы: [(метры, запись)]
+    def nearest(self, lat, lng, limit=5, assignee=None, status=None):
+        def accept(order_id):
+            record = self.records[order_id]
+            return (assignee is None or self.owners.get(order_id) == assignee) and \
+                (status is None or record["Статус"] == status)
+        return [(meters, self.records[order_id]) for meters, order_id in self.geo.nearest(lat, lng, limit, accept)]
+
+    # Ближайший к сотруднику не начатый заказ; срочные по-прежнему раньше
+    # обычных. Без координат у заказов — обычная очередь next_for.
+    def nearest_for(self, assignee, lat, lng):
+        ids = self.by_assignee.get(assignee, {}).get("Назначен, не начат", set())
+        urgent = [order_id for order_id in ids if order_priority_key(self.records[order_id])[0] == 0]
+        candidates = urgent or ids
+        if len(candidates) <= GEO_SCAN_LIMIT:
+            located = [
+                (distance_m(lat, lng, *self.geo.positions[order_id]), order_id)
+                for order_id in candidates if order_id in self.geo.positions
+            ]
+            found = min(located, default=None)
+        else:
+            allowed = set(candidates)
+            found = next(iter(self.geo.nearest(lat, lng, 1, allowed.__contains__)), None)
+        if found is None:
+            return self.next_for(assignee)
+        return self.records[found[1]]
+
+    async def append(self, row):
+        record = self._to_record(row)
+        order_id = record["№ заказа"]
+        if order_id not in self.records:
+            bisect.insort(self.sorted_ids, order_id)
+        self.records[order_id] = record
+        self._index(record)
+        reports.update_order(None, order_contribution(record))
+        self._touch([order_id])
+        self._publish(record)
+        self.backend.append_order(list(row))
+        return record
+
+    async def patch(self, order_id, changes: dict):
+        return self._apply(order_id, changes)
+
+    # Без await внутри: изменение кэша и постановка записи в очередь неделимы
+    def _apply(self, order_id, changes: dict):
+        order_id = parse_order_id(order_id)
+        record = self.records.get(order_id)
+        if record is None:
+            return None
+        reindex = any(column in changes for column in ("Статус", "Ответственный", "ID исполнителя", "Координаты"))
+        previous_owner = self.owners.get(order_id)
+        contribution = order_contribution(record)
+        if reindex:
+            self._unindex(record)
+        record.update(changes)
+        if reindex:
+            self._index(record)
+        reports.update_order(contribution, order_contribution(record))
+        self._touch([order_id])
+        self._publish(record)
+        if self.owners.get(order_id) != previous_owner:
+            events.publish(
+                "order_removed", {"id": order_id, "version": self.version},
+                previous_owner, event_id=self.version,
+            )
+        self.backend.patch_order(order_id, changes)
+        return record
+
+    # Смена статуса по автомату с проверкой версии (compare-and-set).
+    # Проверка и запись идут без await, поэтому одновременные нажатия и
+    # запросы не нужно сериализовать общей блокировкой: второй уже видит
+    # новый статус. Повтор и холостой переход не трогают хранилище.
+    def transition(self, order_id, status: str, changes: dict = None, expected_version=None, key=None):
+        order_id = parse_order_id(order_id)
+        if key is not None:
+            first = self.idempotency.get((key, order_id, status))
+            if first is not None:
+                return "repeated" if first in ("applied", "unchanged") else first, self.records.get(order_id)
+        record = self.records.get(order_id)
+        if record is None:
+            return "not_found", None
+        if record["Статус"] == status:
+            outcome = "unchanged"
+        elif expected_version is not None and self.version_of(order_id) != expected_version:
+            outcome = "conflict"
+        elif status not in ORDER_TRANSITIONS.get(record["Статус"], ORDER_TRANSITIONS[ORDER_NEW_STATUS]):
+            outcome = "conflict"
+        else:
+            self._apply(order_id, {"Статус": status, **(changes or {})})
+            outcome = "applied"
+        if key is not None:
+            self.idempotency.put((key, order_id, status), outcome)
+        return outcome, record
+
+    # Страница заказов от новых к старым. cursor — № последнего заказа
+    # предыдущей страницы. Номера растут со временем создания, поэтому
+    # при фильтре since перебор останавливается на первом более старом заказе.
+    def query(self, assignee=None, status=None, since=None, cursor=None, limit=ORDERS_PAGE_SIZE):
+        if assignee is not None:
+            statuses = self.by_assignee.get(assignee, {})
+            ids = statuses.get(status, set()) if status else set().union(*statuses.values())
+            candidates = sorted(ids, reverse=True)
+            if cursor is not None:
+                candidates = [order_id for order_id in candidates if order_id < cursor]
+        else:
+            end = len(self.sorted_ids) if cursor is None else bisect.bisect_left(self.sorted_ids, cursor)
+            candidates = (self.sorted_ids[i] for i in range(end - 1, -1, -1))
+        page = []
+        for order_id in candidates:
+            record = self.records[order_id]
+            if status and record["Статус"] != status:
+                continue
+            if since is not None:
+                created = parse_date(str(record["Дата создания"]).split(" ")[0])
+                if created is not None and created < since:
+                    break
+            page.append(order_id)
+            if len(page) > limit:
+                break
+        next_cursor = page[limit - 1] if len(page) > limit else None
+        return page[:limit], next_cursor
+
+    def serialized(self, order_id):
+        fragment = self.fragments.get(order_id)
+        if fragment is None:
+            fragment = json.dumps(
+                {**order_to_api(self.records[order_id]), "version": self.version_of(order_id)},
+                ensure_ascii=False,
+            ).encode()
+            self.fragments[order_id] = fragment
+        return fragment
+
+    # Сильный ETag: эпоха + версия кэша + параметры запроса. Версия после
+    # перезапуска начинается заново, эпоха — нет, поэтому старый ETag не совпадёт
+    def etag(self, params):
+        digest = hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+        return f'"{self.epoch}-{self.version}-{digest}"'
+
+    # Готовое тело ответа /api/orders; собирается из JSON отдельных заказов
+    # и живёт до следующего изменения кэша
+    def page_response(self, params):
+        cached = self.responses.get(params)
+        if cached is not None:
+            return cached
+        assignee, status, since, cursor, limit = params
+        page, next_cursor = self.query(assignee, status, since, cursor, limit)
+        body = b"".join((
+            b'{"orders":[',
+            b",".join(self.serialized(order_id) for order_id in page),
+            b'],"next_cursor":',
+            json.dumps(next_cursor).encode(),
+            b',"version":',
+            str(self.version).encode(),
+            b',"epoch":',
+            json.dumps(self.epoch).encode(),
+            b"}",
+        ))
+        if len(self.responses) >= ORDERS_RESPONSE_CACHE:
+            self.responses.clear()
+        cached = self.responses[params] = (self.etag(params), body)
+        return cached
+
+    # № заказов, изменённых после версии since, или None, если журнал
+    # уже не покрывает этот промежуток и клиенту нужна полная загрузка
+    def changes_since(self, since):
+        if since < self.changelog_floor or since > self.version:
+            return None
+        changed = set()
+        for version, order_id in reversed(self.changelog):
+            if version <= since:
+                break
+            changed.add(order_id)
+        return sorted(changed)
+
+    # Ответ /api/orders/changes: изменённые заказы целиком, удалённые
+    # и переданные другому исполнителю — одними номерами
+    def changes_response(self, since, assignee=None):
+        changed = self.changes_since(since)
+        if changed is None:
+            return {"reset": True, "epoch": self.epoch, "version": self.version}
+        orders, removed = [], []
+        for order_id in changed:
+            record = self.records.get(order_id)
+            if record is None or (assignee is not None and self.owners.get(order_id) != assignee):
+                removed.append(order_id)
+            else:
+                orders.append(self.serialized(order_id))
+        return b"".join((
+            b'{"reset":false,"orders":[',
+            b",".join(orders),
+            b'],"removed":',
+            json.dumps(removed).encode(),
+            b',"version":',
+            str(self.version).encode(),
+            b',"epoch":',
+            json.dumps(self.epoch).encode(),
+            b"}",
+        ))
+
+orders_repo = OrdersRepository(storage)
+
+# Кэш учёта смен: открытая смена и последние смены каждого сотрудника в памяти.
+# Смена определяется ключом «сотрудник|дата|начало», поэтому ручные правки
+# листа не сбивают запись в нужную строку.
+SHIFT_HISTORY_SIZE = int(os.getenv("SHIFT_HISTORY_SIZE", "20"))
+
+class ShiftStore:
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+        self.open_shifts = {}   # ID сотрудника → запись открытой смены
+        self.history = {}       # ID сотрудника → последние завершённые смены
+        self.recent = deque(maxlen=SHIFT_HISTORY_SIZE)
+
+    async def load(self):
+        rows = await self.backend.load_shifts()
+        self.open_shifts = {}
+        self.history = {}
+        self.recent.clear()
+        reports.clear("shifts")
+        for row in rows:
+            record = self._to_record(row)
+            if record is not None:
+                self._remember(record)
+                reports.update_shift(None, shift_contribution(record))
+        logger.info(f"🕗 Загружено смен в кэш, открытых: {len(self.open_shifts)}")
+
+    def _to_record(self, row):
+        record = dict(zip(SHIFT_HEADERS, list(row) + [""] * (len(SHIFT_HEADERS) - len(row))))
+        employee_id = parse_order_id(record["ID сотрудника"])
+        if employee_id is None:
+            return None
+        record["ID сотрудника"] = employee_id
+        record["key"] = shift_key(employee_id, record["Дата"], record["Начало смены"], record["ID смены"])
+        return record
+
+    def _remember(self, record):
+        self.recent.append(record)
+        if record["Статус"] == "В процессе":
+            self.open_shifts[record["ID сотрудника"]] = record
+        elif record["Статус"] == "Завершена":
+            self._archive(record)
+
+    def _archive(self, record):
+        employee_id = record["ID сотрудника"]
+        if self.open_shifts.get(employee_id) is record:
+            del self.open_shifts[employee_id]
+        self.history.setdefault(employee_id, deque(maxlen=SHIFT_HISTORY_SIZE)).append(record)
+
+    def open_shift(self, employee_id: int):
+        return self.open_shifts.get(employee_id)
+
+    def history_for(self, employee_id: int):
+        return list(self.history.get(employee_id, ()))
+
+    def start(self, employee_id: int, name: str, date: str, start_time: str):
+        row = [employee_id, name, date, start_time, "", "", "В процессе", uuid.uuid4().hex[:12]]
+        record = self._to_record(row)
+        self._remember(record)
+        self._publish(record)
+        self.backend.append_shift(record["key"], row)
+        return record
+
+    def finish(self, employee_id: int, end_time: str, hours_worked: float):
+        record = self.open_shifts.get(employee_id)
+        if record is None:
+            return None
+        changes = {"Окончание смены": end_time, "Отработано (ч)": hours_worked, "Статус": "Завершена"}
+        contribution = shift_contribution(record)
+        record.update(changes)
+        reports.update_shift(contribution, shift_contribution(record))
+        self._archive(record)
+        self._publish(record)
+        self.backend.patch_shift(record["key"], changes)
+        return record
+
+    def _publish(self, record):
+        events.publish("shift", {
+            "employee_id": record["ID сотрудника"],
+            "name": record["Имя сотрудника"],
+            "date": record["Дата"],
+            "start": record["Начало смены"],
+            "end": record["Окончание смены"],
+            "hours": record["Отработано (ч)"],
+            "status": record["Статус"],
+        }, record["ID сотрудника"])
+
+shift_store = ShiftStore(storage)
+
+# Геопозиции сотрудников. WebApp шлёт точки пачками, сервер отбрасывает
+# почти неподвижные и раз в несколько секунд пишет накопленное одной
+# транзакцией; последняя точка каждого сотрудника всегда есть в памяти.
+LOCATION_MIN_DISTANCE = float(os.getenv("LOCATION_MIN_DISTANCE", "25"))   # метров
+LOCATION_MIN_INTERVAL = float(os.getenv("LOCATION_MIN_INTERVAL", "300"))  # секунд
+LOCATION_FLUSH_INTERVAL = float(os.getenv("LOCATION_FLUSH_INTERVAL", "10"))
+LOCATION_BUFFER_MAX = int(os.getenv("LOCATION_BUFFER_MAX", "5000"))
+LOCATION_BATCH_MAX = int(os.getenv("LOCATION_BATCH_MAX", "500"))
+
+class LocationTracker:
+    def __init__(self, store: LocalStore):
+        self.store = store
+        self.latest = {}    # ID сотрудника → (ts, lat, lng) последней принятой точки
+        self.buffer = []    # (ID сотрудника, ts, lat, lng), ждут записи
+        self.dirty = set()  # сотрудники, чья последняя точка ещё не записана
+        self.wakeup = asyncio.Event()
+
+    def load(self):
+        self.latest = self.store.load_latest_positions()
+        logger.info(f"📍 Загружено последних позиций: {len(self.latest)}")
+
+    # Точка сохраняется, если сотрудник сдвинулся дальше порога
+    # или с прошлой сохранённой точки прошло достаточно времени
+    def ingest(self, employee_id: int, points):
+        accepted = 0
+        for ts, lat, lng in sorted(points):
+            last = self.latest.get(employee_id)
+            if last is not None:
+                if ts <= last[0]:
+                    continue
+                if ts - last[0] < LOCATION_MIN_INTERVAL and distance_m(last[1], last[2], lat, lng) < LOCATION_MIN_DISTANCE:
+                    continue
+            self.latest[employee_id] = (ts, lat, lng)
+            self.buffer.append((employee_id, ts, lat, lng))
+            self.dirty.add(employee_id)
+            accepted += 1
+        if len(self.buffer) >= LOCATION_BUFFER_MAX:
+            self.wakeup.set()
+        return accepted
+
+    def position_of(self, employee_id: int):
+        return self.latest.get(employee_id)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        points, self.buffer = self.buffer, []
+        dirty, self.dirty = self.dirty, set()
+        try:
+            self.store.append_locations(points)
+            self.store.save_latest_positions({employee_id: self.latest[employee_id] for employee_id in dirty})
+        except Exception as e:
+            logger.error(f"Ошибка записи геопозиций ({len(points)} точек): {e}")
+            if len(points) + len(self.buffer) <= LOCATION_BUFFER_MAX:
+                self.buffer[:0] = points
+                self.dirty |= dirty
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), LOCATION_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                self.flush()
+        finally:
+            self.flush()
+
+locations = LocationTracker(local_store)
+
+# Геозоны вокруг объектов: по каждой точке сотрудника проверяются только его
+# активные заказы с координатами. Выход считается с запасом, чтобы дрожание
+# GPS на границе не давало череду прибытий и уходов.
+GEOFENCE_RADIUS = float(os.getenv("GEOFENCE_RADIUS", "100"))          # метров
+GEOFENCE_EXIT_MARGIN = float(os.getenv("GEOFENCE_EXIT_MARGIN", "50"))  # метров
+ACTIVE_STATUSES = ("Назначен, не начат", "В работе")
+
+class GeofenceTracker:
+    def __init__(self, repo: OrdersRepository):
+        self.repo = repo
+        self.inside = {}  # ID сотрудника → (№ заказа, широта, долгота) объекта, где он сейчас
+
+    # Переходы по одной точке: [("arrival" | "departure", № заказа)]
+    def check(self, employee_id: int, lat: float, lng: float):
+        transitions = []
+        current = self.inside.get(employee_id)
+        if current is not None:
+            order_id, site_lat, site_lng = current
+            if distance_m(lat, lng, site_lat, site_lng) <= GEOFENCE_RADIUS + GEOFENCE_EXIT_MARGIN:
+                return transitions
+            del self.inside[employee_id]
+            transitions.append(("departure", order_id))
+        statuses = self.repo.by_assignee.get(employee_id, {})
+        best = None
+        for status in ACTIVE_STATUSES:
+            for order_id in statuses.get(status, ()):
+                position = self.repo.geo.positions.get(order_id)
+                if position is None:
+                    continue
+                meters = distance_m(lat, lng, *position)
+                if meters <= GEOFENCE_RADIUS and (best is None or meters < best[0]):
+                    best = (meters, order_id, position)
+        if best is not None:
+            self.inside[employee_id] = (best[1], *best[2])
+            transitions.append(("arrival", best[1]))
+        return transitions
+
+geofences = GeofenceTracker(orders_repo)
+
+# Локальное хранилище фото (чеки, фото участков). Файл лежит под своим
+# sha256, поэтому одинаковые фото хранятся один раз. Фото из Telegram
+# скачиваются в фоне сразу после получения, пока file_id ещё живой;
+# миниатюры делает Pillow в отдельном процессе.
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(10 * 1024 * 1024)))
+MEDIA_THUMB_SIZE = int(os.getenv("MEDIA_THUMB_SIZE", "320"))
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", "2"))
+MEDIA_DOWNLOAD_ATTEMPTS = int(os.getenv("MEDIA_DOWNLOAD_ATTEMPTS", "5"))
+# Фото отдаются с домена бота, поэтому принимаются только растровые форматы,
+# определённые по содержимому, а не по заявленному клиентом типу
+MEDIA_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# Формат по содержимому файла (Pillow); None — не фото или формат не разрешён
+def detect_image_mime(content: bytes):
+    from PIL import Image, UnidentifiedImageError
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.verify()
+            return MEDIA_FORMATS.get(image.format)
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        return None
+
+# Запись через свой временный файл в том же каталоге: одновременные записи
+# одного пути не мешают друг другу, а читатель видит только целый файл
+def replace_atomically(path: str, write):
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write(file)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+# Выполняется в пуле процессов, поэтому это функция модуля, а не метод
+def make_thumbnail(source: str, target: str, size: int):
+    from PIL import Image, ImageOps
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        thumbnail = image.convert("RGB")
+    replace_atomically(target, lambda file: thumbnail.save(file, "JPEG", quality=80, optimize=True))
+
+class MediaStore:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, "thumbs"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, "media.db"))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS media (
+                hash TEXT PRIMARY KEY, size INTEGER NOT NULL, mime TEXT NOT NULL, created TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS media_links (
+                kind TEXT NOT NULL, ref TEXT NOT NULL, hash TEXT NOT NULL, created TEXT NOT NULL,
+                PRIMARY KEY (kind, ref, hash));
+            CREATE TABLE IF NOT EXISTS telegram_files (
+                file_unique_id TEXT PRIMARY KEY, hash TEXT NOT NULL);
+        """)
+        self.db.commit()
+        self.downloads = asyncio.Queue()
+        self.inflight = {}  # file_unique_id → идущее скачивание, чтобы не качать дважды
+        self.thumb_pool = None
+
+    def path(self, digest: str):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def thumb_path(self, digest: str):
+        return os.path.join(self.root, "thumbs", f"{digest}.jpg")
+
+    def mime_of(self, digest: str):
+        row = self.db.execute("SELECT mime FROM media WHERE hash = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _write(path: str, content: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        replace_atomically(path, lambda file: file.write(content))
+
+    # Тип файла определяется здесь же; не JPEG/PNG/WebP — ValueError
+    async def store(self, content: bytes):
+        digest = hashlib.sha256(content).hexdigest()
+        if self.mime_of(digest) is None:
+            loop = asyncio.get_running_loop()
+            mime = await loop.run_in_executor(None, detect_image_mime, content)
+            if mime is None:
+                raise ValueError("Not an image")
+            await loop.run_in_executor(None, self._write, self.path(digest), content)
+            self.db.execute(
+                "INSERT OR IGNORE INTO media (hash, size, mime, created) VALUES (?, ?, ?, ?)",
+                (digest, len(content), mime, datetime.now().isoformat(timespec="seconds")),
+            )
+            self.db.commit()
+            asyncio.create_task(self._thumbnail(digest))
+        return digest
+
+    async def _thumbnail(self, digest: str):
+        if self.thumb_pool is None:
+            self.thumb_pool = ProcessPoolExecutor(max_workers=1)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.thumb_pool, make_thumbnail, self.path(digest), self.thumb_path(digest), MEDIA_THUMB_SIZE,
+            )
+        except ImportError:
+            logger.warning("⚠️ Pillow не установлен, миниатюры не создаются")
+        except Exception as e:
+            logger.error(f"Не удалось сделать миниатюру {digest}: {e}")
+
+    def link(self, kind: str, ref, digest: str):
+        self.db.execute(
+            "INSERT OR IGNORE INTO media_links (kind, ref, hash, created) VALUES (?, ?, ?, ?)",
+            (kind, str(ref), digest, datetime.now().isoformat(timespec="seconds")),
+        )
+        self.db.commit()
+
+    def links(self, kind: str, ref):
+        return [digest for (digest,) in self.db.execute(
+            "SELECT hash FROM media_links WHERE kind = ? AND ref = ? ORDER BY created", (kind, str(ref)),
+        )]
 
-# Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+    # Обратное: к каким заказам привязан файл — [(kind, ref), ...]
+    def owners_of(self, digest: str):
+        return self.db.execute("SELECT kind, ref FROM media_links WHERE hash = ?", (digest,)).fetchall()
 
-# Список сотрудников: {Telegram ID: "Имя Фамилия"}
-TEAM_MEMBERS = {
-    693411047: "Баранов Антон",
-    987654321: "Петрова Мария",
-    555666777: "Сидоров Дмитрий"
-}
+    # Фото из Telegram: скачать в фоне и привязать к заказу
+    def fetch_telegram(self, file_id: str, kind: str, ref):
+        self.downloads.put_nowait((file_id, kind, ref, 1))
 
-# Подключение к Google Sheets — ИСПРАВЛЕНО!
-scope = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive"
-]
-creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", scope)
-client = gspread.authorize(creds)
-
-# Открываем таблицу заказов
-try:
-    sheet = client.open("Заказы на участки").sheet1
-except gspread.SpreadsheetNotFound:
-    logger.error("Таблица 'Заказы на участки' не найдена.")
-    raise Exception("❌ Таблица 'Заказы на участки' не найдена. Создайте её в Google Таблицах.")
-
-# Создаём заголовки, если таблица пустая
-if not sheet.get_all_values():
-    sheet.append_row([
-        "№ заказа", "Адрес", "Тип работы", "Срок", "Комментарий",
-        "Приоритет", "Статус", "Ответственный", "Дата создания",
-        "Начал работу", "Выполнил работу", "Сумма", "Способ оплаты",
-        "Препарат", "Количество", "Площадь", "Фото чека", "Координаты"
-    ])
-
-# Открываем таблицу для учёта смен
-try:
-    shifts_sheet = client.open("Учёт смен").sheet1
-except gspread.SpreadsheetNotFound:
-    logger.error("Таблица 'Учёт смен' не найдена.")
-    raise Exception("❌ Таблица 'Учёт смен' не найдена. Создайте её в Google Таблицах.")
-
-if not shifts_sheet.get_all_values():
-    shifts_sheet.append_row([
-        "ID сотрудника", "Имя сотрудника", "Дата", "Начало смены",
-        "Окончание смены", "Отработано (ч)", "Статус"
-    ])
+    async def _download(self, file_id: str):
+        file = await bot.get_file(file_id)
+        known = self.db.execute(
+            "SELECT hash FROM telegram_files WHERE file_unique_id = ?", (file.file_unique_id,),
+        ).fetchone()
+        if known is not None:
+            return known[0]
+        task = self.inflight.get(file.file_unique_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(file.file_path, file.file_unique_id))
+            self.inflight[file.file_unique_id] = task
+            task.add_done_callback(lambda _: self.inflight.pop(file.file_unique_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, file_path: str, file_unique_id: str):
+        content = await bot.download_file(file_path, destination=io.BytesIO())
+        digest = await self.store(content.getvalue())
+        self.db.execute(
+            "INSERT OR IGNORE INTO telegram_files (file_unique_id, hash) VALUES (?, ?)",
+            (file_unique_id, digest),
+        )
+        self.db.commit()
+        return digest
+
+    async def _worker(self):
+        while True:
+            file_id, kind, ref, attempt = await self.downloads.get()
+            try:
+                self.link(kind, ref, await self._download(file_id))
+            except Exception as e:
+                if attempt >= MEDIA_DOWNLOAD_ATTEMPTS:
+                    logger.error(f"Не удалось скачать фото {kind} {ref}: {e}")
+                else:
+                    asyncio.get_running_loop().call_later(
+                        min(300, 2 ** attempt), self.downloads.put_nowait, (file_id, kind, ref, attempt + 1),
+                    )
+
+    async def run(self):
+        await asyncio.gather(*(self._worker() for _ in range(MEDIA_DOWNLOAD_WORKERS)))
+
+media = MediaStore(MEDIA_DIR)
+
+# Периодическая сверка кэшей с хранилищем
+async def cache_resync_loop():
+    while True:
+        await asyncio.sleep(ORDERS_RESYNC_INTERVAL)
+        try:
+            await storage.refresh()
+            if storage.reload_on_resync:
+                await orders_repo.load()
+                await shift_store.load()
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации кэша: {e}")
+
+# Запуск без ожидания Google: веб-сервер и бот поднимаются сразу, таблицы
+# подключаются и кэши прогреваются в фоне. Живость — GET /api/live,
+# готовность к работе — GET /api/ready.
+SHEETS_CONNECT_TIMEOUT = float(os.getenv("SHEETS_CONNECT_TIMEOUT", "60"))
+STARTUP_WAIT_TIMEOUT = float(os.getenv("STARTUP_WAIT_TIMEOUT", "5"))
+data_ready = asyncio.Event()
+startup_timings = {}  # этап → секунды от старта процесса
+
+def mark_startup(stage: str):
+    startup_timings[stage] = round(time.monotonic() - PROCESS_STARTED, 3)
+    logger.info(f"⏱ {stage}: {startup_timings[stage]} с после старта")
+
+# Блокирующее подключение, выполняется в пуле шлюза
+def open_mirror_worksheets():
+    global client
+    if SHEETS_MODE == "google":
+        creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", scope)
+        client = gspread.authorize(creds)
+    for mirror in (orders_mirror, shifts_mirror):
+        if mirror is not None and mirror.worksheet is None:
+            mirror.worksheet = open_worksheet(mirror.title, mirror.headers)
+
+# Повторяем подключение, пока Google не ответит: сбой таблиц не роняет бота
+async def connect_sheets():
+    attempt = 0
+    while True:
+        try:
+            await sheets.call(open_mirror_worksheets, timeout=SHEETS_CONNECT_TIMEOUT)
+            mark_startup("sheets_connected")
+            write_queue.wakeup.set()
+            return
+        except Exception as e:
+            attempt += 1
+            delay = min(WRITE_QUEUE_MAX_BACKOFF, 2 ** attempt)
+            logger.error(f"Не удалось подключиться к Google Sheets (попытка {attempt}), повтор через {delay} с: {e}")
+            await asyncio.sleep(delay)
+
+async def warm_up():
+    sheets_connected = orders_mirror is None
+    if storage.needs_sheets():
+        await connect_sheets()
+        sheets_connected = True
+    attempt = 0
+    while True:
+        try:
+            await storage.prepare()
+            roster.load()
+            await orders_repo.load()
+            await shift_store.load()
+            locations.load()
+            break
+        except Exception as e:
+            attempt += 1
+            delay = min(WRITE_QUEUE_MAX_BACKOFF, 2 ** attempt)
+            logger.error(f"❌ Ошибка прогрева кэшей (попытка {attempt}), повтор через {delay} с: {e}")
+            await asyncio.sleep(delay)
+    data_ready.set()
+    mark_startup("data_ready")
+    # Меню команд зависит от ролей, поэтому ставится только после roster.load()
+    await set_bot_commands()
+    asyncio.create_task(cache_resync_loop())
+    if not sheets_connected:
+        await connect_sheets()
+    asyncio.create_task(roster_reload_loop())
+
+# Перечитывает состав из источника; при изменениях переиндексирует заказы
+# и обновляет меню команд администраторов. Незаписанные правки /team уходят
+# в лист раньше чтения, чтобы лист их не затёр. В режиме storage лист
+# читается, только пока состав не сверен с ним после заполнения пустой базы.
+async def reload_roster():
+    former_admins = set(roster.admin_ids())
+    if roster.dirty:
+        await roster.save_sheet()
+    if SHEETS_MODE != "off" and (ROSTER_SOURCE == "sheet" or roster.seeded):
+        changed = await roster.load_sheet()
+        if roster.dirty:
+            await roster.save_sheet()
+    else:
+        changed = roster.load()
+    if changed:
+        logger.info(f"👥 Состав команды обновлён: {len(roster.members)} чел.")
+        await apply_roster_change(former_admins)
+    return changed
+
+async def apply_roster_change(former_admins):
+    orders_repo.reindex_owners()
+    await set_bot_commands(former_admins - set(roster.admin_ids()))
+
+async def roster_reload_loop():
+    while True:
+        try:
+            await reload_roster()
+        except Exception as e:
+            logger.error(f"❌ Не удалось перечитать состав команды: {e}")
+        await asyncio.sleep(ROSTER_RELOAD_INTERVAL)
 
 # Состояния для FSM
 class OrderForm(StatesGroup):
@@ -94,16 +2463,9 @@ class OrderForm(StatesGroup):
     quantity = State()
     area = State()
 
-# Генерация уникального номера заказа
-def generate_order_id():
-    records = sheet.get_all_values()
-    if len(records) <= 1:
-        return 1001
-    last_id = int(records[-1][0]) if records[-1][0].isdigit() else 1000
-    return last_id + 1
-
 # Установка команд
-async def set_bot_commands():
+# former_admins — у кого забрали роль администратора: им возвращаем общее меню
+async def set_bot_commands(former_admins=()):
     try:
         admin_commands = [
             types.BotCommand(command="new", description="🆕 Создать заказ"),
@@ -111,7 +2473,9 @@ async def set_bot_commands():
             types.BotCommand(command="get_receipt", description="🧾 Просмотр чека"),
             types.BotCommand(command="cancel", description="🚫 Отменить действие"),
             types.BotCommand(command="start", description="🏠 Главное меню"),
-            types.BotCommand(command="export", description="📊 Экспорт данных")
+            types.BotCommand(command="export", description="📊 Экспорт данных"),
+            types.BotCommand(command="report", description="📈 Сводный отчёт"),
+            types.BotCommand(command="team", description="👥 Состав команды")
         ]
         worker_commands = [
             types.BotCommand(command="start", description="🏠 Главное меню"),
@@ -121,8 +2485,10 @@ async def set_bot_commands():
             types.BotCommand(command="shift_my", description="📊 Мои смены"),
             types.BotCommand(command="cancel", description="🚫 Отменить")
         ]
-        for admin_id in ADMIN_IDS:
+        for admin_id in roster.admin_ids():
             await bot.set_my_commands(admin_commands, scope=types.BotCommandScopeChat(chat_id=admin_id))
+        for user_id in former_admins:
+            await bot.delete_my_commands(scope=types.BotCommandScopeChat(chat_id=user_id))
         await bot.set_my_commands(worker_commands, scope=types.BotCommandScopeAllPrivateChats())
         logger.info("✅ Команды установлены")
 
@@ -143,14 +2509,14 @@ async def cancel_handler(message: types.Message, state: FSMContext):
 # Обработчики команд
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
-    if message.from_user.id in ADMIN_IDS:
+    if roster.is_admin(message.from_user.id):
         await show_admin_menu(message)
     else:
         await show_worker_menu(message)
 
 @dp.message(Command("new"))
 async def cmd_new(message: types.Message, state: FSMContext):
-    if message.from_user.id not in ADMIN_IDS:
+    if not roster.is_admin(message.from_user.id):
         await message.answer("🚫 Только администратор может создавать заказы.")
         return
     await message.answer("📍 Введите адрес участка:")
@@ -158,23 +2524,70 @@ async def cmd_new(message: types.Message, state: FSMContext):
 
 @dp.message(Command("admin"))
 async def cmd_admin(message: types.Message):
-    if message.from_user.id not in ADMIN_IDS:
+    if not roster.is_admin(message.from_user.id):
         await message.answer("🚫 Доступ запрещён.")
         return
     await show_admin_menu(message)
 
+# Состав команды: /team — список, /team add <ID> <роли> <Имя Фамилия>,
+# /team remove <ID>, /team reload — перечитать состав из источника
+@dp.message(Command("team"))
+async def team_command(message: types.Message):
+    if not roster.is_admin(message.from_user.id):
+        await message.answer("🚫 Только администратор может управлять составом.")
+        return
+    parts = message.text.split(maxsplit=4)
+    action = parts[1].lower() if len(parts) > 1 else "list"
+    try:
+        if action in ("add", "remove") and roster.seeded:
+            await message.answer(f"⏳ Состав ещё загружается из таблицы «{ROSTER_SHEET}», повторите через минуту.")
+            return
+        former_admins = set(roster.admin_ids())
+        if action == "reload":
+            changed = await reload_roster()
+            await message.answer("🔄 Состав обновлён." if changed else "ℹ️ Состав не изменился.")
+        elif action == "add":
+            user_id = parse_order_id(parts[2]) if len(parts) > 2 else None
+            if user_id is None or len(parts) < 5:
+                raise ValueError("Используйте: /team add 123456789 worker Иванов Иван")
+            roster.upsert(user_id, parts[4], parse_roles(parts[3]))
+            await apply_roster_change(former_admins)
+        elif action == "remove":
+            user_id = parse_order_id(parts[2]) if len(parts) > 2 else None
+            if user_id is None:
+                raise ValueError("Используйте: /team remove 123456789")
+            if not roster.remove(user_id):
+                raise ValueError(f"Сотрудника {user_id} нет в составе")
+            await apply_roster_change(former_admins)
+        elif action != "list":
+            raise ValueError("Неизвестная команда. Доступны: add, remove, reload")
+        if action in ("add", "remove") and roster.dirty:
+            try:
+                await roster.save_sheet()
+            except Exception as e:
+                logger.error(f"Не удалось записать состав в лист: {e}")
+                await message.answer(f"⚠️ Таблица «{ROSTER_SHEET}» недоступна, изменения запишутся в неё позже.")
+        lines = [
+            f"{'👑' if 'admin' in member['roles'] else '👷'} {member['name']} — {user_id} ({format_roles(member['roles'])})"
+            for user_id, member in roster.members.items()
+        ]
+        await message.answer("👥 Состав команды:\n" + "\n".join(lines))
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+    except Exception as e:
+        logger.error(f"Ошибка управления составом: {e}")
+        await message.answer("❌ Ошибка сервера.")
+
 @dp.message(Command("orders"))
 async def view_all_orders(message: types.Message):
     try:
         user_id = message.from_user.id
-        if user_id not in TEAM_MEMBERS:
+        if not roster.is_worker(user_id):
             await message.answer("❌ Вы не зарегистрированы как сотрудник.")
             return
-        records = sheet.get_all_records()
         my_orders = [
             f"🆕 #{r['№ заказа']} | {r['Адрес']} | {r['Тип работы']} | {r['Статус']}"
-            for r in records
-            if r['Ответственный'] == TEAM_MEMBERS[user_id] and r['Статус'] != "Выполнен"
+            for r in orders_repo.active_for(user_id)
         ]
         if my_orders:
             await message.answer("📋 Ваши назначенные заказы:\n" + "\n".join(my_orders))
@@ -186,7 +2599,7 @@ async def view_all_orders(message: types.Message):
 
 @dp.message(Command("cancel"))
 async def cancel_order(message: types.Message):
-    if message.from_user.id not in ADMIN_IDS:
+    if not roster.is_admin(message.from_user.id):
         await message.answer("🚫 Только администратор может отменять заказы.")
         return
     try:
@@ -196,25 +2609,23 @@ async def cancel_order(message: types.Message):
             return
         order_id = int(parts[1])
         now = datetime.now().strftime("%d.%m.%Y %H:%M")
-        cell = sheet.find(str(order_id))
-        if not cell:
+        order = orders_repo.get(order_id)
+        if not order:
             await message.answer(f"❌ Заказ #{order_id} не найден.")
             return
-        assignee_name = sheet.cell(cell.row, 8).value
-        assignee_id = None
-        for uid, name in TEAM_MEMBERS.items():
-            if name == assignee_name:
-                assignee_id = uid
-                break
-        if not assignee_id:
+        assignee_name = order['Ответственный']
+        assignee_id = orders_repo.owners.get(order_id)
+        if not isinstance(assignee_id, int):
             await message.answer(f"❌ Не удалось найти сотрудника для заказа #{order_id}.")
             return
-        sheet.update_cell(cell.row, 7, "Отменён")
-        sheet.update_cell(cell.row, 11, f"Отменено {now}")
-        try:
-            await bot.send_message(assignee_id, f"🚫 Заказ #{order_id} отменён администратором.\n🕒 {now}")
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение сотруднику: {e}")
+        outcome, _ = orders_repo.transition(order_id, "Отменён", {"Выполнил работу": f"Отменено {now}"})
+        if outcome == "unchanged":
+            await message.answer(f"ℹ️ Заказ #{order_id} уже отменён.")
+            return
+        if outcome == "conflict":
+            await message.answer(f"❌ Заказ #{order_id} в статусе «{order['Статус']}», отменить нельзя.")
+            return
+        outbox.send(assignee_id, f"🚫 Заказ #{order_id} отменён администратором.\n🕒 {now}")
         await message.answer(f"✅ Заказ #{order_id} отменён. Уведомление отправлено {assignee_name}.")
     except ValueError:
         await message.answer("❌ Неверный формат. Используйте: /cancel 1001")
@@ -224,7 +2635,7 @@ async def cancel_order(message: types.Message):
 
 @dp.message(Command("get_receipt"))
 async def get_receipt(message: types.Message):
-    if message.from_user.id not in ADMIN_IDS:
+    if not roster.is_admin(message.from_user.id):
         await message.answer("🚫 Только администратор может просматривать чеки.")
         return
     try:
@@ -233,12 +2644,18 @@ async def get_receipt(message: types.Message):
             await message.answer("❌ Укажите номер заказа: /get_receipt 1001")
             return
         order_id = int(parts[1])
-        cell = sheet.find(str(order_id))
-        if not cell:
+        order = orders_repo.get(order_id)
+        if not order:
             await message.answer(f"❌ Заказ #{order_id} не найден.")
             return
-        receipt_photo_id = sheet.cell(cell.row, 17).value
-        if receipt_photo_id == "без чека" or not receipt_photo_id:
+        stored = media.links("receipt", order_id)
+        receipt_photo_id = local_store.get_receipt(order_id) or order['Фото чека']
+        if stored:
+            # Локальная копия не зависит от срока жизни файла в Telegram
+            await message.answer_photo(
+                types.FSInputFile(media.path(stored[-1])), caption=f"🧾 Чек к заказу #{order_id}"
+            )
+        elif receipt_photo_id == "без чека" or not receipt_photo_id:
             await message.answer(f"🧾 Чек к заказу #{order_id} не прикреплён.")
         else:
             try:
@@ -251,30 +2668,154 @@ async def get_receipt(message: types.Message):
         logger.error(f"Ошибка при получении чека: {e}")
         await message.answer("❌ Ошибка сервера.")
 
-# Экспорт данных
+# Экспорт заказов. Отбор строк идёт в цикле событий порциями, запись
+# файла — в отдельном потоке, поэтому в памяти не больше одной порции,
+# а бот не подвисает на больших выгрузках. Результат — временный файл.
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+
+class CsvExportWriter:
+    def __init__(self, path: str):
+        # utf-8-sig — чтобы Excel сразу открывал кириллицу
+        self.file = open(path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.file)
+
+    def write_rows(self, rows: list):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+class XlsxExportWriter:
+    def __init__(self, path: str):
+        import openpyxl  # нужен только для XLSX
+        self.path = path
+        # write_only пишет строки сразу во временный XML, не держа лист в памяти
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet("Заказы")
+
+    def write_rows(self, rows: list):
+        for row in rows:
+            self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "xlsx": XlsxExportWriter}
+
+class ExportFilters:
+    def __init__(self, date_from=None, date_to=None, status=None, assignee=None):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.status = status
+        self.assignee = assignee
+
+    def matches(self, record):
+        if self.status and record["Статус"] != self.status:
+            return False
+        if self.assignee and orders_repo.owners.get(record["№ заказа"]) != self.assignee:
+            return False
+        if self.date_from or self.date_to:
+            created = parse_date(str(record["Дата создания"]).split(" ")[0])
+            if created is None:
+                return False
+            if self.date_from and created < self.date_from:
+                return False
+            if self.date_to and created > self.date_to:
+                return False
+        return True
+
+    def describe(self):
+        parts = []
+        if self.date_from:
+            parts.append(f"с {self.date_from:%d.%m.%Y}")
+        if self.date_to:
+            parts.append(f"по {self.date_to:%d.%m.%Y}")
+        if self.status:
+            parts.append(f"статус «{self.status}»")
+        if self.assignee:
+            parts.append(str(roster.name_of(self.assignee, self.assignee)))
+        return ", ".join(parts) or "все заказы"
+
+# Возвращает (путь к временному файлу, число строк); файл удаляет вызывающий
+async def export_orders_file(fmt: str, filters: ExportFilters):
+    loop = asyncio.get_running_loop()
+    fd, path = tempfile.mkstemp(prefix="orders_", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        writer = await loop.run_in_executor(export_executor, EXPORT_WRITERS[fmt], path)
+        try:
+            await loop.run_in_executor(export_executor, writer.write_rows, [ORDER_HEADERS])
+            count = 0
+            chunk = []
+            for order_id in list(orders_repo.sorted_ids):
+                record = orders_repo.records.get(order_id)
+                if record is None or not filters.matches(record):
+                    continue
+                chunk.append([record[column] for column in ORDER_HEADERS])
+                if len(chunk) >= EXPORT_CHUNK_ROWS:
+                    await loop.run_in_executor(export_executor, writer.write_rows, chunk)
+                    count += len(chunk)
+                    chunk = []
+            if chunk:
+                await loop.run_in_executor(export_executor, writer.write_rows, chunk)
+                count += len(chunk)
+        finally:
+            await loop.run_in_executor(export_executor, writer.close)
+        return path, count
+    except BaseException:
+        os.unlink(path)
+        raise
+
+# /export [csv|xlsx] [from=ДД.ММ.ГГГГ] [to=ДД.ММ.ГГГГ] [status=...] [assignee=...]
+# Значения с пробелами берутся в кавычки: assignee="Баранов Антон"
+def parse_export_args(text: str):
+    fmt = "csv"
+    filters = ExportFilters()
+    for token in shlex.split(text or "")[1:]:
+        key, _, value = token.partition("=")
+        if not value and key.lower() in EXPORT_WRITERS:
+            fmt = key.lower()
+        elif key in ("from", "to"):
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(f"Неверная дата: {value}")
+            setattr(filters, "date_from" if key == "from" else "date_to", day)
+        elif key == "status":
+            filters.status = value
+        elif key == "assignee":
+            filters.assignee = resolve_assignee(value)
+        else:
+            raise ValueError(f"Неизвестный параметр: {token}")
+    return fmt, filters
+
 @dp.message(Command("export"))
 async def export_orders(message: types.Message):
-    if message.from_user.id not in ADMIN_IDS:
+    if not roster.is_admin(message.from_user.id):
         await message.answer("🚫 Только администратор может экспортировать данные.")
         return
     try:
-        records = sheet.get_all_records()
-        import io
-        output = io.StringIO()
-        import csv
-        writer = csv.writer(output)
-        if records:
-            writer.writerow(records[0].keys())
-            for r in records:
-                writer.writerow(r.values())
-        output.seek(0)
+        fmt, filters = parse_export_args(message.text)
+    except ValueError as e:
+        await message.answer(
+            f"❌ {e}\nПример: /export xlsx from=01.01.2026 to=31.12.2026 status=Выполнен assignee=\"Баранов Антон\""
+        )
+        return
+    path = None
+    try:
+        path, count = await export_orders_file(fmt, filters)
         await message.answer_document(
-            types.BufferedInputFile(output.getvalue().encode('utf-8'), filename="orders.csv"),
-            caption="📊 Экспорт всех заказов"
+            types.FSInputFile(path, filename=f"orders_{datetime.now():%Y%m%d_%H%M}.{fmt}"),
+            caption=f"📊 Экспорт заказов: {filters.describe()} ({count} шт.)"
         )
+    except ImportError:
+        await message.answer("❌ Для XLSX на сервере не установлен openpyxl. Используйте /export csv.")
     except Exception as e:
         logger.error(f"Ошибка экспорта: {e}")
         await message.answer("❌ Ошибка экспорта.")
+    finally:
+        if path is not None:
+            os.unlink(path)
 
 # Меню
 async def show_worker_menu(message: types.Message):
@@ -291,6 +2832,7 @@ async def show_admin_menu(message: types.Message):
     kb.button(text="🆕 Создать заказ", callback_data="admin_new_order")
     kb.button(text="📊 Отчёт по сменам", callback_data="admin_shift_report")
     kb.button(text="📋 Все заказы", callback_data="admin_all_orders")
+    kb.button(text="📈 Сводка за неделю", callback_data="admin_report_week")
     kb.button(
         text="✨ Панель как в Figma",
         web_app=WebAppInfo(url="https://ab646487-hash.github.io/telegram-bot-webapp/")
@@ -308,7 +2850,7 @@ async def admin_new_order(callback: types.CallbackQuery, state: FSMContext):
 @dp.callback_query(lambda c: c.data == "admin_shift_report")
 async def admin_shift_report(callback: types.CallbackQuery):
     try:
-        records = shifts_sheet.get_all_records()[-10:]
+        records = list(shift_store.recent)[-10:]
         if not records:
             await callback.message.edit_text("📭 Нет данных по сменам.")
         else:
@@ -322,10 +2864,109 @@ async def admin_shift_report(callback: types.CallbackQuery):
         logger.error(f"Ошибка в отчёте по сменам: {e}")
         await callback.answer("❌ Ошибка")
 
+# Текстовая сводка за период из накопленных итогов
+def format_report(date_from, date_to):
+    period = f"{date_from:%d.%m.%Y} – {date_to:%d.%m.%Y}"
+    hours = reports.query("shifts", "employee", date_from, date_to)
+    by_employee = reports.query("orders", "employee", date_from, date_to)
+    by_payment = reports.query("orders", "payment", date_from, date_to)
+    by_work = reports.query("orders", "work_type", date_from, date_to)
+    by_chemical = reports.query("orders", "chemical", date_from, date_to)
+    lines = [f"📈 Сводка за {period}", ""]
+    lines.append("⏱ Часы по сотрудникам:")
+    lines += [f"  👤 {r['employee']}: {r['hours']} ч. ({r['shifts']} смен)" for r in hours] or ["  —"]
+    lines.append("")
+    lines.append("✅ Выполнено заказов:")
+    lines += [f"  👷 {r['employee'] or '—'}: {r['orders']} шт., {r['revenue']} руб." for r in by_employee] or ["  —"]
+    lines.append("")
+    lines.append("💳 Выручка по способу оплаты:")
+    lines += [f"  {r['payment'] or '—'}: {r['revenue']} руб." for r in by_payment] or ["  —"]
+    lines.append("")
+    lines.append("⚒ По типам работ:")
+    lines += [f"  {r['work_type'] or '—'}: {r['orders']} шт., {r['area']} площади" for r in by_work] or ["  —"]
+    lines.append("")
+    lines.append("🧪 Расход препаратов на единицу площади:")
+    lines += [
+        f"  {r['chemical'] or '—'}: {r['quantity']} на {r['area']} = {round(r['quantity'] / r['area'], 3) if r['area'] else '—'}"
+        for r in by_chemical
+    ] or ["  —"]
+    return "\n".join(lines)
+
+# Telegram не принимает сообщения длиннее 4096 символов: режем по строкам
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT):
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        # Строка длиннее лимита целиком не влезет никуда — режем её саму
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            candidate = line
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+# today | week | month или from=ДД.ММ.ГГГГ to=ДД.ММ.ГГГГ; по умолчанию — последние 7 дней
+def parse_report_period(text: str):
+    today = datetime.now().date()
+    date_from, date_to = today - timedelta(days=6), today
+    for token in (text or "").split()[1:]:
+        key, _, value = token.partition("=")
+        if key == "today":
+            date_from = today
+        elif key == "week":
+            date_from = today - timedelta(days=6)
+        elif key == "month":
+            date_from = today - timedelta(days=29)
+        elif key in ("from", "to") and parse_date(value):
+            if key == "from":
+                date_from = parse_date(value)
+            else:
+                date_to = parse_date(value)
+        else:
+            raise ValueError(f"Неизвестный параметр: {token}")
+    return date_from, date_to
+
+@dp.message(Command("report"))
+async def admin_report(message: types.Message):
+    if not roster.is_admin(message.from_user.id):
+        await message.answer("🚫 Только администратор может смотреть отчёты.")
+        return
+    try:
+        date_from, date_to = parse_report_period(message.text)
+    except ValueError as e:
+        await message.answer(f"❌ {e}\nПример: /report month или /report from=01.03.2026 to=31.03.2026")
+        return
+    try:
+        for chunk in split_message(format_report(date_from, date_to)):
+            await message.answer(chunk)
+    except Exception as e:
+        logger.error(f"Ошибка сводного отчёта: {e}")
+        await message.answer("❌ Ошибка сервера.")
+
+@dp.callback_query(lambda c: c.data == "admin_report_week")
+async def admin_report_week(callback: types.CallbackQuery):
+    try:
+        date_from, date_to = parse_report_period("/report week")
+        for chunk in split_message(format_report(date_from, date_to)):
+            await callback.message.answer(chunk)
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка сводного отчёта: {e}")
+        await callback.answer("❌ Ошибка")
+
 @dp.callback_query(lambda c: c.data == "admin_all_orders")
 async def admin_all_orders(callback: types.CallbackQuery):
     try:
-        records = sheet.get_all_records()[-10:]
+        records = orders_repo.all()[-10:]
         if not records:
             await callback.message.edit_text("📭 Нет заказов.")
         else:
@@ -344,19 +2985,17 @@ async def admin_all_orders(callback: types.CallbackQuery):
 async def shift_start(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
-        if user_id not in TEAM_MEMBERS:
+        if not roster.is_worker(user_id):
             await callback.answer("❌ Вы не зарегистрированы как сотрудник.")
             return
         now = datetime.now()
         today = now.strftime("%d.%m.%Y")
         time_str = now.strftime("%H:%M")
-        records = shifts_sheet.get_all_records()
-        for record in records[::-1]:
-            if record['ID сотрудника'] == user_id and record['Дата'] == today and record['Статус'] == "В процессе":
-                await callback.answer("❌ У вас уже начата смена сегодня!")
-                return
-        row = [user_id, TEAM_MEMBERS[user_id], today, time_str, "", "", "В процессе"]
-        shifts_sheet.append_row(row)
+        open_shift = shift_store.open_shift(user_id)
+        if open_shift and open_shift['Дата'] == today:
+            await callback.answer("❌ У вас уже начата смена сегодня!")
+            return
+        shift_store.start(user_id, roster.name_of(user_id), today, time_str)
         await callback.message.edit_text(f"✅ Смена начата в {time_str}")
         await send_next_order(user_id)
         await callback.answer()
@@ -368,29 +3007,19 @@ async def shift_start(callback: types.CallbackQuery):
 async def shift_end(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
-        if user_id not in TEAM_MEMBERS:
+        if not roster.is_worker(user_id):
             await callback.answer("❌ Вы не зарегистрированы как сотрудник.")
             return
         now = datetime.now()
-        today = now.strftime("%d.%m.%Y")
         end_time_str = now.strftime("%H:%M")
-        records = shifts_sheet.get_all_records()
-        row_index = None
-        start_time_str = None
-        for i, record in enumerate(records[::-1], start=2):
-            if record['ID сотрудника'] == user_id and record['Статус'] == "В процессе":
-                row_index = len(records) - (i - 2)
-                start_time_str = record['Начало смены']
-                break
-        if not row_index:
+        shift = shift_store.open_shift(user_id)
+        if not shift:
             await callback.answer("❌ У вас нет активной смены!")
             return
-        start_dt = datetime.strptime(f"{today} {start_time_str}", "%d.%m.%Y %H:%M")
-        end_dt = datetime.strptime(f"{today} {end_time_str}", "%d.%m.%Y %H:%M")
+        start_dt = datetime.strptime(f"{shift['Дата']} {shift['Начало смены']}", "%d.%m.%Y %H:%M")
+        end_dt = now.replace(second=0, microsecond=0)
         hours_worked = (end_dt - start_dt).total_seconds() / 3600
-        shifts_sheet.update_cell(row_index, 5, end_time_str)
-        shifts_sheet.update_cell(row_index, 6, round(hours_worked, 2))
-        shifts_sheet.update_cell(row_index, 7, "Завершена")
+        shift_store.finish(user_id, end_time_str, round(hours_worked, 2))
         await callback.message.edit_text(f"✅ Смена завершена.\nОтработано: {round(hours_worked, 2)} ч.")
         await callback.answer()
     except Exception as e:
@@ -401,14 +3030,12 @@ async def shift_end(callback: types.CallbackQuery):
 async def shift_my(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
-        if user_id not in TEAM_MEMBERS:
+        if not roster.is_worker(user_id):
             await callback.answer("❌ Вы не зарегистрированы как сотрудник.")
             return
-        records = shifts_sheet.get_all_records()
         my_shifts = [
             f"📅 {r['Дата']} | 🕗 {r['Начало смены']}–{r['Окончание смены']} | ⏱ {r['Отработано (ч)']} ч."
-            for r in records
-            if r['ID сотрудника'] == user_id and r['Статус'] == "Завершена"
+            for r in shift_store.history_for(user_id)
         ][-5:]
         if my_shifts:
             await callback.message.edit_text("📋 Ваши последние смены:\n" + "\n".join(my_shifts))
@@ -454,7 +3081,7 @@ async def set_priority(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(priority=priority)
     await callback.message.edit_text(f"⏳ Приоритет: {priority}")
     kb = InlineKeyboardBuilder()
-    for user_id, name in TEAM_MEMBERS.items():
+    for user_id, name in roster.workers():
         kb.button(text=name, callback_data=f"assign_{user_id}")
     kb.adjust(1)
     await callback.message.answer("👷 Выберите исполнителя:", reply_markup=kb.as_markup())
@@ -463,8 +3090,11 @@ async def set_priority(callback: types.CallbackQuery, state: FSMContext):
 @dp.callback_query(lambda c: c.data.startswith("assign_"))
 async def set_assignee(callback: types.CallbackQuery, state: FSMContext):
     user_id = int(callback.data.split("_")[1])
+    if not roster.is_worker(user_id):
+        await callback.answer("❌ Сотрудника уже нет в составе, выберите другого.")
+        return
     await state.update_data(assignee=user_id)
-    await callback.message.edit_text(f"👷 Исполнитель: {TEAM_MEMBERS[user_id]}")
+    await callback.message.edit_text(f"👷 Исполнитель: {roster.name_of(user_id)}")
     await callback.message.answer("📷 Пришлите фото участка (или напишите 'без фото'):")
     await state.set_state(OrderForm.photo)
 
@@ -482,26 +3112,26 @@ async def skip_photo(message: types.Message, state: FSMContext):
 async def finalize_order(message: types.Message, state: FSMContext):
     try:
         data = await state.get_data()
-        order_id = generate_order_id()
-        row = [
-            order_id, data['address'], data['work_type'], data['deadline'], data['comment'],
-            data['priority'], "Назначен, не начат", TEAM_MEMBERS[data['assignee']],
-            datetime.now().strftime("%d.%m.%Y"), "", "", "", "", "", "", "", "", ""
-        ]
-        sheet.append_row(row)
+        order_id = await order_ids.next_id()
+        assignee_id = data['assignee']
+        values = {
+            "№ заказа": order_id, "Адрес": data['address'], "Тип работы": data['work_type'],
+            "Срок": data['deadline'], "Комментарий": data['comment'], "Приоритет": data['priority'],
+            "Статус": "Назначен, не начат", "Ответственный": roster.name_of(assignee_id, str(assignee_id)),
+            "Дата создания": datetime.now().strftime("%d.%m.%Y"), "ID исполнителя": assignee_id,
+        }
+        await orders_repo.append([values.get(column, "") for column in ORDER_HEADERS])
+        if data.get('photo'):
+            media.fetch_telegram(data['photo'], "site", order_id)
         
         # Уведомляем исполнителя
-        assignee_id = data['assignee']
-        try:
-            await bot.send_message(
-                assignee_id,
-                f"🆕 Вам назначен новый заказ #{order_id}!\n📍 {data['address']}\n⚒ {data['work_type']}",
-                reply_markup=InlineKeyboardBuilder()
-                    .button(text="Открыть панель", web_app=WebAppInfo(url="https://ab646487-hash.github.io/telegram-bot-webapp/"))
-                    .as_markup()
-            )
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление: {e}")
+        outbox.send(
+            assignee_id,
+            f"🆕 Вам назначен новый заказ #{order_id}!\n📍 {data['address']}\n⚒ {data['work_type']}",
+            reply_markup=InlineKeyboardBuilder()
+                .button(text="Открыть панель", web_app=WebAppInfo(url="https://ab646487-hash.github.io/telegram-bot-webapp/"))
+                .as_markup()
+        )
             
         text = (
             f"🆕 Заказ #{order_id} успешно назначен!\n"
@@ -519,52 +3149,77 @@ async def finalize_order(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка при создании заказа.")
 
 # Автоматическая выдача заказов
+# DISPATCH_MODE=nearest: следующий заказ — ближайший к последней позиции
+# сотрудника, если она свежая; иначе обычная очередь по приоритету и сроку
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "queue")
+DISPATCH_POSITION_MAX_AGE = float(os.getenv("DISPATCH_POSITION_MAX_AGE", "1800"))
+
+def pick_next_order(user_id: int):
+    if DISPATCH_MODE == "nearest":
+        position = locations.position_of(user_id)
+        if position is not None and time.time() - position[0] <= DISPATCH_POSITION_MAX_AGE:
+            return orders_repo.nearest_for(user_id, position[1], position[2])
+    return orders_repo.next_for(user_id)
+
 async def send_next_order(user_id: int):
     try:
-        records = sheet.get_all_records()
-        for record in records:
-            if record['Ответственный'] == TEAM_MEMBERS[user_id] and record['Статус'] == "Назначен, не начат":
-                order_id = record['№ заказа']
-                text = (
-                    f"▶️ НОВЫЙ ЗАКАЗ #{order_id}\n"
-                    f"📍 Адрес: {record['Адрес']}\n"
-                    f"⚒ Работа: {record['Тип работы']}\n"
-                    f"📅 Срок: {record['Срок']}\n"
-                    f"📝 Комментарий: {record['Комментарий']}\n"
-                    f"⏳ Приоритет: {record['Приоритет']}"
-                )
-                kb = InlineKeyboardBuilder()
-                kb.button(text="▶️ Начал работу", callback_data=f"start_{order_id}")
-                kb.button(text="✅ Выполнил работу", callback_data=f"done_{order_id}")
-                kb.adjust(2)
-                await bot.send_message(user_id, text, reply_markup=kb.as_markup())
-                cell = sheet.find(str(order_id))
-                if cell:
-                    sheet.update_cell(cell.row, 7, "В работе")
-                    sheet.update_cell(cell.row, 10, datetime.now().strftime("%d.%m.%Y %H:%M"))
-                return
-        await bot.send_message(user_id, "🎉 Все заказы выполнены! Отдыхайте 😊")
+        record = pick_next_order(user_id)
+        if record is None:
+            outbox.send(user_id, "🎉 Все заказы выполнены! Отдыхайте 😊")
+            return
+        order_id = record['№ заказа']
+        text = (
+            f"▶️ НОВЫЙ ЗАКАЗ #{order_id}\n"
+            f"📍 Адрес: {record['Адрес']}\n"
+            f"⚒ Работа: {record['Тип работы']}\n"
+            f"📅 Срок: {record['Срок']}\n"
+            f"📝 Комментарий: {record['Комментарий']}\n"
+            f"⏳ Приоритет: {record['Приоритет']}"
+        )
+        kb = InlineKeyboardBuilder()
+        kb.button(text="▶️ Начал работу", callback_data=f"start_{order_id}")
+        kb.button(text="✅ Выполнил работу", callback_data=f"done_{order_id}")
+        kb.adjust(2)
+        outbox.send(user_id, text, reply_markup=kb.as_markup())
+        orders_repo.transition(order_id, "В работе", {"Начал работу": datetime.now().strftime("%d.%m.%Y %H:%M")})
     except Exception as e:
         logger.error(f"Ошибка при отправке следующего заказа: {e}")
 
+# Двойное нажатие одной и той же кнопки одного сообщения — один ключ
+def callback_key(callback: types.CallbackQuery):
+    message = callback.message
+    if message is None:
+        return f"tg:{callback.from_user.id}:{callback.data}"
+    return f"tg:{message.chat.id}:{message.message_id}:{callback.data}"
+
 # Обработка кнопок заказа
 @dp.callback_query(lambda c: c.data.startswith("start_"))
 async def mark_started(callback: types.CallbackQuery):
     try:
         order_id = int(callback.data.split("_")[1])
         now = datetime.now().strftime("%d.%m.%Y %H:%M")
-        cell = sheet.find(str(order_id))
-        if not cell:
+        outcome, record = orders_repo.transition(order_id, "В работе", {"Начал работу": now}, key=callback_key(callback))
+        if outcome == "not_found":
             await callback.answer("Заказ не найден.")
             return
-        sheet.update_cell(cell.row, 7, "В работе")
-        sheet.update_cell(cell.row, 10, now)
+        if outcome == "repeated":
+            await callback.answer()
+            return
+        if outcome == "conflict":
+            await callback.answer(f"Заказ #{order_id} уже в статусе «{record['Статус']}».", show_alert=True)
+            return
+        # Заказ мог перейти в работу раньше — при выдаче ботом или из WebApp
+        now = record["Начал работу"] or now
         kb = InlineKeyboardBuilder()
         kb.button(text="✅ Выполнил работу", callback_data=f"done_{order_id}")
         kb.adjust(1)
         await callback.message.edit_text(f"{callback.message.text}\n\n▶️ РАБОТА НАЧАТА\n🕒 {now}", reply_markup=kb.as_markup())
         await callback.answer("Хорошей работы!")
-        await bot.send_message(ADMIN_IDS[0], f"▶️ Заказ #{order_id} — начал работу!\n👷‍♂️ Исполнитель: {callback.from_user.full_name}\n🕒 {now}")
+        outbox.broadcast(
+            roster.admin_ids(),
+            f"▶️ Заказ #{order_id} — начал работу!\n👷‍♂️ Исполнитель: {callback.from_user.full_name}\n🕒 {now}",
+            PRIORITY_BULK,
+        )
     except Exception as e:
         logger.error(f"Ошибка при начале работы: {e}")
         await callback.answer("❌ Ошибка сервера.")
@@ -573,6 +3228,13 @@ async def mark_started(callback: types.CallbackQuery):
 async def mark_done(callback: types.CallbackQuery, state: FSMContext):
     try:
         order_id = int(callback.data.split("_")[1])
+        record = orders_repo.get(order_id)
+        if record is None:
+            await callback.answer("Заказ не найден.")
+            return
+        if record["Статус"] in CLOSED_STATUSES:
+            await callback.answer(f"Заказ #{order_id} уже в статусе «{record['Статус']}».", show_alert=True)
+            return
         await state.update_data(order_id=order_id)
         await callback.message.edit_text("💰 Введите сумму заказа:")
         await state.set_state(OrderForm.amount)
@@ -632,21 +3294,33 @@ async def get_area(message: types.Message, state: FSMContext):
     data = await state.get_data()
     order_id = data['order_id']
     now = datetime.now().strftime("%d.%m.%Y %H:%M")
-    cell = sheet.find(str(order_id))
-    if not cell:
+    details = {
+        "Сумма": data['amount'],
+        "Способ оплаты": data['payment'],
+        "Препарат": data['chemical'],
+        "Количество": data['quantity'],
+        "Площадь": data['area'],
+        "Фото чека": data.get('receipt_photo', "без чека"),
+    }
+    outcome, record = orders_repo.transition(order_id, "Выполнен", {"Выполнил работу": now, **details})
+    if outcome == "not_found":
         await message.answer("❌ Заказ не найден.")
         return
-    sheet.update_cell(cell.row, 7, "Выполнен")
-    sheet.update_cell(cell.row, 11, now)
-    sheet.update_cell(cell.row, 12, data['amount'])
-    sheet.update_cell(cell.row, 13, data['payment'])
-    sheet.update_cell(cell.row, 14, data['chemical'])
-    sheet.update_cell(cell.row, 15, data['quantity'])
-    sheet.update_cell(cell.row, 16, data['area'])
-    sheet.update_cell(cell.row, 17, data.get('receipt_photo', "без чека"))
+    if outcome == "conflict":
+        await message.answer(f"❌ Заказ #{order_id} уже в статусе «{record['Статус']}», данные не сохранены.")
+        await state.clear()
+        return
+    if outcome == "unchanged":
+        # Заказ уже закрыли из WebApp — дописываем только то, что изменилось
+        details = {column: value for column, value in details.items() if record.get(column) != value}
+        if details:
+            await orders_repo.patch(order_id, details)
+    if data.get('receipt_photo', "без чека") != "без чека":
+        local_store.save_receipt(order_id, data['receipt_photo'])
+        media.fetch_telegram(data['receipt_photo'], "receipt", order_id)
     report = (
         f"🎉 Заказ #{order_id} ВЫПОЛНЕН!\n"
-        f"👷‍♂️ Исполнитель: {TEAM_MEMBERS.get(data.get('assignee'), 'Неизвестно')}\n"
+        f"👷‍♂️ Исполнитель: {record['Ответственный'] or 'Неизвестно'}\n"
         f"🕒 {now}\n\n"
         f"💰 Сумма: {data['amount']} руб.\n"
         f"💳 Оплата: {data['payment']}\n"
@@ -656,8 +3330,7 @@ async def get_area(message: types.Message, state: FSMContext):
         f"📐 Площадь: {data['area']}"
     )
     await message.answer("✅ Заказ завершён! Данные сохранены.")
-    for admin_id in ADMIN_IDS:
-        await bot.send_message(admin_id, report)
+    outbox.broadcast(roster.admin_ids(), report)
     await send_next_order(message.from_user.id)
     await state.clear()
 
@@ -666,14 +3339,12 @@ async def get_area(message: types.Message, state: FSMContext):
 async def my_orders_list(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
-        if user_id not in TEAM_MEMBERS:
+        if not roster.is_worker(user_id):
             await callback.answer("❌ Вы не зарегистрированы как сотрудник.")
             return
-        records = sheet.get_all_records()
         my_orders = [
             f"🆕 #{r['№ заказа']} | {r['Адрес']} | {r['Тип работы']} | {r['Статус']}"
-            for r in records
-            if r['Ответственный'] == TEAM_MEMBERS[user_id] and r['Статус'] != "Выполнен"
+            for r in orders_repo.active_for(user_id)
         ]
         if my_orders:
             await callback.message.edit_text("📋 Ваши назначенные заказы:\n" + "\n".join(my_orders))
@@ -685,95 +3356,733 @@ async def my_orders_list(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка сервера.")
 
 # 🆕 API для WebApp — отдаёт список заказов в JSON
+# Фильтр по исполнителю из запроса WebApp: имя или Telegram ID, приводится
+# к ключу индексов заказов. Администратор по своему ID видит всех.
+def resolve_assignee(value):
+    if not value:
+        return None
+    if value.isdigit():
+        user_id = int(value)
+        if roster.is_admin(user_id) and not roster.is_worker(user_id):
+            return None
+        return user_id
+    return roster.id_of(value) or value
+
+# Параметры: assignee (имя или Telegram ID), status, since (ГГГГ-ММ-ДД или ДД.ММ.ГГГГ),
+# cursor и limit для постраничной выдачи. Клиент с актуальным ETag получает 304.
 async def get_orders(request):
     try:
-        records = sheet.get_all_records()
-        orders = []
-        for r in records:
-            orders.append({
-                "id": r.get('№ заказа', ''),
-                "address": r.get('Адрес', ''),
-                "work_type": r.get('Тип работы', ''),
-                "deadline": r.get('Срок', ''),
-                "status": r.get('Статус', ''),
-                "assignee": r.get('Ответственный', ''),
-                "priority": r.get('Приоритет', 'Обычный'),
-                "coordinates": r.get('Координаты', '')
-            })
-        return web.json_response(orders)
+        query = request.query
+        assignee = resolve_assignee(query.get('assignee'))
+        status = query.get('status') or None
+        since = None
+        if query.get('since'):
+            since = parse_date(query['since'])
+            if since is None:
+                return web.json_response({"error": "Неверный формат since"}, status=400)
+        cursor = None
+        if query.get('cursor'):
+            cursor = parse_order_id(query['cursor'])
+            if cursor is None:
+                return web.json_response({"error": "Неверный cursor"}, status=400)
+        try:
+            limit = min(max(int(query.get('limit', ORDERS_PAGE_SIZE)), 1), ORDERS_PAGE_MAX)
+        except ValueError:
+            return web.json_response({"error": "Неверный limit"}, status=400)
+
+        params = (assignee, status, since, cursor, limit)
+        headers = {"Cache-Control": "no-cache"}
+        etag = orders_repo.etag(params)
+        if_none_match = request.headers.get("If-None-Match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return web.Response(status=304, headers={**headers, "ETag": etag})
+        etag, body = orders_repo.page_response(params)
+        return web.Response(
+            body=body, content_type="application/json", charset="utf-8",
+            headers={**headers, "ETag": etag},
+        )
     except Exception as e:
         logger.error(f"Ошибка при получении заказов: {e}")
         return web.json_response({"error": str(e)}, status=500)
 
-# 🆕 API для начала заказа
-async def start_order(request):
+# 🆕 Изменения заказов после версии since — WebApp догружает только их.
+# Если эпоха не совпала или журнал уже короче, отвечаем reset: true.
+async def get_order_changes(request):
+    try:
+        try:
+            since = int(request.query.get('since', ''))
+        except ValueError:
+            return web.json_response({"error": "Неверный since"}, status=400)
+        assignee = resolve_assignee(request.query.get('assignee'))
+        if request.query.get('epoch') != orders_repo.epoch:
+            since = -1
+        result = orders_repo.changes_response(since, assignee)
+        if isinstance(result, dict):
+            return web.json_response(result)
+        return web.Response(body=result, content_type="application/json", charset="utf-8")
+    except Exception as e:
+        logger.error(f"Ошибка при получении изменений заказов: {e}")
+        return web.json_response({"error": str(e)}, status=500)
+
+# Действия исполнителя с заказом: новый статус и колонка с отметкой времени
+ORDER_ACTIONS = {
+    "start_order": ("В работе", "Начал работу"),
+    "complete_order": ("Выполнен", "Выполнил работу"),
+}
+
+# at — время действия на телефоне (мс), если оно копилось офлайн;
+# version — версия заказа, которую видел клиент; key — ключ идемпотентности
+def apply_order_action(action, order_id, at=None, version=None, key=None):
+    status, column = ORDER_ACTIONS[action]
+    moment = datetime.fromtimestamp(at / 1000) if at else datetime.now()
+    return orders_repo.transition(
+        order_id, status, {column: moment.strftime("%d.%m.%Y %H:%M")}, expected_version=version, key=key,
+    )
+
+# Ответ API на смену статуса и его HTTP-код
+def order_action_result(outcome, record):
+    version = orders_repo.version_of(record["№ заказа"]) if record else None
+    if outcome == "not_found":
+        return {"success": False, "error": "Order not found"}, 200
+    if outcome == "conflict":
+        return {"success": False, "error": "Conflict", "status": record["Статус"], "version": version}, 409
+    return {"success": True, "duplicate": outcome != "applied", "version": version}, 200
+
+def parse_version(value):
+    return str(value).strip() or None if value is not None else None
+
+async def order_action_api(request, action):
     order_id = request.query.get('order_id')
     if not order_id:
         return web.json_response({"success": False, "error": "No order_id"})
     try:
-        cell = sheet.find(str(order_id))
-        if not cell:
-            return web.json_response({"success": False, "error": "Order not found"})
-        sheet.update_cell(cell.row, 7, "В работе")
-        sheet.update_cell(cell.row, 10, datetime.now().strftime("%d.%m.%Y %H:%M"))
-        return web.json_response({"success": True})
+        body, status = order_action_result(*apply_order_action(
+            action, order_id,
+            version=parse_version(request.query.get('version')),
+            key=request.headers.get("Idempotency-Key") or request.query.get('key'),
+        ))
+        return web.json_response(body, status=status)
     except Exception as e:
-        logger.error(f"Ошибка при начале заказа: {e}")
+        logger.error(f"Ошибка при смене статуса заказа ({action}): {e}")
         return web.json_response({"success": False, "error": str(e)})
 
+# Точки из запроса: {"lat", "lng", "ts"} по одной или списком в "points".
+# ts — время на телефоне в мс; без него берётся время сервера.
+def parse_location_points(data):
+    raw = data.get('points')
+    if raw is None:
+        raw = [data]
+    points = []
+    for point in raw[:LOCATION_BATCH_MAX]:
+        lat, lng = float(point['lat']), float(point['lng'])
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            continue
+        ts = point.get('ts')
+        points.append((float(ts) / 1000 if ts else time.time(), lat, lng))
+    return points
+
+# employee_id — только из подписанного initData, не из тела запроса
+async def record_locations(employee_id: int, data):
+    points = parse_location_points(data)
+    accepted = locations.ingest(employee_id, points)
+    # Прибытие и уход отмечаются только сотрудникам из состава.
+    # Геозоны проверяются по всем точкам, а не только по сохранённым.
+    if not roster.is_worker(employee_id):
+        return accepted
+    for ts, lat, lng in sorted(points):
+        for kind, order_id in geofences.check(employee_id, lat, lng):
+            await record_site_visit(employee_id, kind, order_id, ts)
+    return accepted
+
+# Прибытие пишется один раз — первое; уход — каждый раз, остаётся последний.
+# Отмечается только в заказе самого сотрудника: пока он был на объекте,
+# заказ могли передать другому.
+async def record_site_visit(employee_id: int, kind: str, order_id: int, ts: float):
+    record = orders_repo.get(order_id)
+    if record is None or orders_repo.owners.get(order_id) != employee_id:
+        return
+    moment = datetime.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M")
+    column = "Прибыл на объект" if kind == "arrival" else "Покинул объект"
+    if kind == "departure" or not record[column]:
+        await orders_repo.patch(order_id, {column: moment})
+    name = roster.name_of(employee_id, employee_id)
+    events.publish("site_visit", {
+        "order_id": order_id, "kind": kind, "employee_id": employee_id, "employee": name, "at": moment,
+    }, orders_repo.owners.get(order_id))
+    text = (
+        f"📍 {name} прибыл на объект #{order_id}\n🏠 {record['Адрес']}\n🕒 {moment}"
+        if kind == "arrival" else
+        f"🚗 {name} покинул объект #{order_id}\n🏠 {record['Адрес']}\n🕒 {moment}"
+    )
+    outbox.broadcast(roster.admin_ids(), text, PRIORITY_BULK)
+
+def send_sos():
+    # Отправляем уведомление администраторам раньше любых других сообщений
+    outbox.broadcast(roster.admin_ids(), "🚨 ЭКСТРЕННЫЙ СИГНАЛ! Сотруднику требуется помощь!", PRIORITY_URGENT)
+
+# 🆕 API для начала заказа
+async def start_order(request):
+    return await order_action_api(request, "start_order")
+
 # 🆕 API для завершения заказа
 async def complete_order(request):
+    return await order_action_api(request, "complete_order")
+
+# 🆕 API для обновления местоположения; сотрудник — по initData
+async def update_location(request):
+    employee_id = webapp_user_id(request)
+    if employee_id is None:
+        return web.json_response({"success": False, "error": "Forbidden"}, status=403)
+    try:
+        data = await request.json()
+        accepted = await record_locations(employee_id, data)
+        return web.json_response({"success": True, "accepted": accepted})
+    except Exception as e:
+        logger.error(f"Ошибка обновления местоположения: {e}")
+        return web.json_response({"success": False, "error": str(e)})
+
+# 🆕 Ручная отметка прибытия — когда геолокация на телефоне выключена.
+# Обычно прибытие определяется сервером по потоку точек.
+async def arrive_at_order(request):
     order_id = request.query.get('order_id')
     if not order_id:
         return web.json_response({"success": False, "error": "No order_id"})
     try:
-        cell = sheet.find(str(order_id))
-        if not cell:
+        record = orders_repo.get(order_id)
+        if record is None:
             return web.json_response({"success": False, "error": "Order not found"})
-        sheet.update_cell(cell.row, 7, "Выполнен")
-        sheet.update_cell(cell.row, 11, datetime.now().strftime("%d.%m.%Y %H:%M"))
+        if not record['Прибыл на объект']:
+            await orders_repo.patch(order_id, {"Прибыл на объект": datetime.now().strftime("%d.%m.%Y %H:%M")})
+        return web.json_response({"success": True, "arrived_at": record['Прибыл на объект']})
+    except Exception as e:
+        logger.error(f"Ошибка отметки прибытия: {e}")
+        return web.json_response({"success": False, "error": str(e)})
+
+# 🆕 API для SOS сигнала
+async def sos_alert(request):
+    try:
+        send_sos()
         return web.json_response({"success": True})
     except Exception as e:
-        logger.error(f"Ошибка при завершении заказа: {e}")
+        logger.error(f"Ошибка SOS сигнала: {e}")
         return web.json_response({"success": False, "error": str(e)})
 
-# 🆕 API для обновления местоположения
-async def update_location(request):
+# 🆕 Пакетная отправка накопленных офлайн действий одним запросом.
+# Тело: {"actions": [{"id": ..., "type": ..., "order_id": ..., "at": ...}, ...]}
+# Результат по каждому действию возвращается с тем же id. Сотрудник — по
+# initData; менять статус он может только в своих заказах.
+SYNC_MAX_ACTIONS = int(os.getenv("SYNC_MAX_ACTIONS", "200"))
+
+async def sync_actions(request):
+    employee_id = webapp_user_id(request)
+    if employee_id is None:
+        return web.json_response({"success": False, "error": "Forbidden"}, status=403)
     try:
         data = await request.json()
-        lat = data.get('lat')
-        lng = data.get('lng')
-        # Здесь можно сохранить координаты в таблицу
-        logger.info(f"Обновление местоположения: {lat}, {lng}")
-        return web.json_response({"success": True})
+        actions = data.get('actions') if isinstance(data, dict) else None
+        if not isinstance(actions, list):
+            return web.json_response({"success": False, "error": "No actions"}, status=400)
+        if len(actions) > SYNC_MAX_ACTIONS:
+            return web.json_response({"success": False, "error": "Too many actions"}, status=413)
+        results = []
+        for action in actions:
+            result = {"id": action.get('id'), "success": True}
+            try:
+                kind = action.get('type')
+                order_id = parse_order_id(action.get('order_id'))
+                if kind in ORDER_ACTIONS and order_id in orders_repo.records \
+                        and orders_repo.owners.get(order_id) != employee_id:
+                    result.update(success=False, error="Forbidden")
+                elif kind in ORDER_ACTIONS:
+                    # id действия — тот же ключ, с которым телефон пробовал отправить его онлайн
+                    body, _ = order_action_result(*apply_order_action(
+                        kind, action.get('order_id'), action.get('at'),
+                        version=parse_version(action.get('version')), key=action.get('id'),
+                    ))
+                    result.update(body)
+                elif kind == "update_location":
+                    await record_locations(employee_id, action)
+                elif kind == "sos_alert":
+                    send_sos()
+                else:
+                    result.update(success=False, error="Unknown action")
+            except Exception as e:
+                logger.error(f"Ошибка офлайн действия {action.get('type')}: {e}")
+                result.update(success=False, error=str(e))
+            results.append(result)
+        return web.json_response({"success": True, "results": results, "version": orders_repo.version})
     except Exception as e:
-        logger.error(f"Ошибка обновления местоположения: {e}")
+        logger.error(f"Ошибка синхронизации: {e}")
         return web.json_response({"success": False, "error": str(e)})
 
-# 🆕 API для SOS сигнала
-async def sos_alert(request):
+# 🆕 Поток событий для WebApp: заказы и смены без опроса сервера.
+# Подписчик — по initData (EventSource не шлёт заголовки, поэтому параметром
+# init_data): администратор получает всё, сотрудник — только свои события.
+async def stream_events(request):
+    user_id = webapp_user_id(request)
+    if roster.is_admin(user_id):
+        assignee = None
+    elif roster.is_worker(user_id):
+        assignee = user_id
+    else:
+        return web.json_response({"error": "Forbidden"}, status=403)
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    await response.prepare(request)
+    queue = events.subscribe(assignee)
     try:
-        # Отправляем уведомление администраторам
-        for admin_id in ADMIN_IDS:
-            await bot.send_message(admin_id, "🚨 ЭКСТРЕННЫЙ СИГНАЛ! Сотруднику требуется помощь!")
-        return web.json_response({"success": True})
+        hello = json.dumps({"version": orders_repo.version, "epoch": orders_repo.epoch})
+        await response.write(f"retry: 3000\nevent: hello\ndata: {hello}\n\n".encode())
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                message = b": ping\n\n"
+            if message is None:
+                break
+            await response.write(message)
+    except ConnectionResetError:
+        pass
+    finally:
+        events.unsubscribe(queue)
+    return response
+
+# 🆕 Ближайшие открытые заказы к точке: lat, lng, limit, assignee, status
+async def get_nearest_orders(request):
+    try:
+        query = request.query
+        try:
+            lat, lng = float(query['lat']), float(query['lng'])
+            limit = min(max(int(query.get('limit', 5)), 1), 50)
+        except (KeyError, ValueError):
+            return web.json_response({"error": "Нужны lat и lng"}, status=400)
+        found = orders_repo.nearest(
+            lat, lng, limit, resolve_assignee(query.get('assignee')), query.get('status') or None,
+        )
+        return web.json_response([
+            {**order_to_api(record), "distance_m": round(meters)} for meters, record in found
+        ])
     except Exception as e:
-        logger.error(f"Ошибка SOS сигнала: {e}")
+        logger.error(f"Ошибка поиска ближайших заказов: {e}")
+        return web.json_response({"error": str(e)}, status=500)
+
+# Пользователь WebApp по заголовку X-Telegram-Init-Data; подпись проверяется
+# ключом бота, как описано в документации Telegram Mini Apps
+WEBAPP_AUTH_MAX_AGE = int(os.getenv("WEBAPP_AUTH_MAX_AGE", "86400"))
+
+def webapp_user_id(request):
+    init_data = request.headers.get("X-Telegram-Init-Data") or request.query.get("init_data")
+    if not init_data or not BOT_TOKEN:
+        return None
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop("hash", "")
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received_hash):
+        return None
+    if time.time() - int(fields.get("auth_date", "0")) > WEBAPP_AUTH_MAX_AGE:
+        return None
+    try:
+        return int(json.loads(fields.get("user", "{}"))["id"])
+    except (KeyError, ValueError, TypeError):
+        return None
+
+# Заказ доступен его исполнителю и администраторам
+def may_access_order(user_id, order_id):
+    if roster.is_admin(user_id):
+        return True
+    order_id = parse_order_id(order_id)
+    return order_id in orders_repo.records and orders_repo.owners.get(order_id) == user_id
+
+# 🆕 Выгрузка заказов файлом: format=csv|xlsx, from, to, status, assignee.
+# Только для администраторов; файл отдаётся частями и сразу удаляется.
+async def export_orders_api(request):
+    if not roster.is_admin(webapp_user_id(request)):
+        return web.json_response({"error": "Forbidden"}, status=403)
+    query = request.query
+    fmt = query.get('format', 'csv').lower()
+    if fmt not in EXPORT_WRITERS:
+        return web.json_response({"error": "Неверный format"}, status=400)
+    filters = ExportFilters(status=query.get('status') or None, assignee=resolve_assignee(query.get('assignee')))
+    for key in ("from", "to"):
+        if query.get(key):
+            day = parse_date(query[key])
+            if day is None:
+                return web.json_response({"error": f"Неверный {key}"}, status=400)
+            setattr(filters, "date_from" if key == "from" else "date_to", day)
+    path = response = None
+    try:
+        path, count = await export_orders_file(fmt, filters)
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/csv; charset=utf-8" if fmt == "csv"
+                else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            "Content-Disposition": f'attachment; filename="orders_{datetime.now():%Y%m%d_%H%M}.{fmt}"',
+            "X-Export-Rows": str(count),
+        })
+        response.content_length = os.path.getsize(path)
+        await response.prepare(request)
+        loop = asyncio.get_running_loop()
+        with open(path, "rb") as file:
+            while True:
+                chunk = await loop.run_in_executor(export_executor, file.read, 256 * 1024)
+                if not chunk:
+                    break
+                await response.write(chunk)
+        await response.write_eof()
+        return response
+    except ImportError:
+        return web.json_response({"error": "openpyxl не установлен"}, status=501)
+    except Exception as e:
+        logger.error(f"Ошибка экспорта: {e}")
+        # Заголовки уже ушли — остаётся только оборвать передачу
+        if response is not None and response.prepared:
+            return response
+        return web.json_response({"error": str(e)}, status=500)
+    finally:
+        if path is not None:
+            os.unlink(path)
+
+# 🆕 Сводные отчёты: kind=orders|shifts, group=day|week|month|employee|
+# work_type|payment|chemical, from, to. Только для администраторов.
+async def get_reports(request):
+    if not roster.is_admin(webapp_user_id(request)):
+        return web.json_response({"error": "Forbidden"}, status=403)
+    query = request.query
+    kind = query.get('kind', 'orders')
+    if kind not in ("orders", "shifts"):
+        return web.json_response({"error": "Неверный kind"}, status=400)
+    bounds = {}
+    for key in ("from", "to"):
+        if query.get(key):
+            bounds[key] = parse_date(query[key])
+            if bounds[key] is None:
+                return web.json_response({"error": f"Неверный {key}"}, status=400)
+    try:
+        rows = reports.query(kind, query.get('group', 'day'), bounds.get("from"), bounds.get("to"))
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    return web.json_response({"kind": kind, "rows": rows})
+
+MEDIA_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+# Файл под своим хэшем никогда не меняется — кэшировать можно навсегда, но
+# только на устройстве: фото отдаются лишь тем, кому они доступны.
+# nosniff не даёт браузеру угадывать тип вместо отданного
+MEDIA_CACHE_HEADERS = {"Cache-Control": "private, max-age=31536000, immutable", "X-Content-Type-Options": "nosniff"}
+
+def media_urls(digest: str):
+    return {"hash": digest, "url": f"/media/{digest}", "thumb": f"/media/{digest}/thumb"}
+
+# Видеть фото может администратор; исполнитель — фото объекта своих заказов
+# и непривязанные фото. Чеки — только администраторы.
+def may_view_media(user_id, digest: str):
+    if roster.is_admin(user_id):
+        return True
+    if not roster.is_worker(user_id):
+        return False
+    links = media.owners_of(digest)
+    return not links or any(kind == "site" and may_access_order(user_id, ref) for kind, ref in links)
+
+# 🆕 Фото по хэшу; FileResponse сам отвечает на Range и If-None-Match.
+# Пока миниатюры нет (или нет Pillow), вместо неё отдаётся оригинал.
+# initData — заголовком или параметром init_data (для <img src>).
+async def serve_media(request):
+    digest = request.match_info['digest']
+    mime = media.mime_of(digest) if MEDIA_HASH_RE.match(digest) else None
+    if mime not in MEDIA_FORMATS.values() or not may_view_media(webapp_user_id(request), digest):
+        raise web.HTTPNotFound()
+    if request.match_info.get('variant') == "thumb" and os.path.exists(media.thumb_path(digest)):
+        return web.FileResponse(media.thumb_path(digest), headers={**MEDIA_CACHE_HEADERS, "Content-Type": "image/jpeg"})
+    return web.FileResponse(media.path(digest), headers={**MEDIA_CACHE_HEADERS, "Content-Type": mime})
+
+# 🆕 Список фото заказа для галереи WebApp: kind=receipt|site, ref=№ заказа.
+# Фото объекта — исполнителю заказа и администраторам, чеки — только администраторам.
+async def list_media(request):
+    kind = request.query.get('kind', 'site')
+    ref = request.query.get('ref', '')
+    user_id = webapp_user_id(request)
+    allowed = roster.is_admin(user_id) if kind == "receipt" else may_access_order(user_id, ref)
+    if not allowed:
+        return web.json_response({"error": "Forbidden"}, status=403)
+    return web.json_response([media_urls(digest) for digest in media.links(kind, ref)])
+
+# 🆕 Загрузка фото из WebApp (multipart: photo, необязательный order_id).
+# Файл читается потоком и обрывается на MEDIA_MAX_BYTES; тип определяется
+# по содержимому, заголовок Content-Type части не учитывается. Загружать
+# могут сотрудники из состава, к заказу — только его исполнитель или администратор.
+async def upload_photo(request):
+    user_id = webapp_user_id(request)
+    if not (roster.is_worker(user_id) or roster.is_admin(user_id)):
+        return web.json_response({"success": False, "error": "Forbidden"}, status=403)
+    try:
+        reader = await request.multipart()
+        content, order_id = None, None
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if part.name == "order_id":
+                order_id = parse_order_id(await part.text())
+                if order_id is not None and not may_access_order(user_id, order_id):
+                    return web.json_response({"success": False, "error": "Forbidden"}, status=403)
+            elif part.name == "photo":
+                buffer = bytearray()
+                while chunk := await part.read_chunk():
+                    buffer.extend(chunk)
+                    if len(buffer) > MEDIA_MAX_BYTES:
+                        return web.json_response({"success": False, "error": "Too large"}, status=413)
+                content = bytes(buffer)
+        if not content:
+            return web.json_response({"success": False, "error": "No photo"}, status=400)
+        try:
+            digest = await media.store(content)
+        except ValueError:
+            return web.json_response({"success": False, "error": "Not an image"}, status=415)
+        if order_id is not None:
+            media.link("site", order_id, digest)
+        return web.json_response({"success": True, **media_urls(digest)})
+    except Exception as e:
+        logger.error(f"Ошибка загрузки фото: {e}")
         return web.json_response({"success": False, "error": str(e)})
 
+# Сэмплирующий профилировщик: отдельный поток с интервалом снимает стек потока
+# цикла событий и копит свёрнутые стеки (формат flamegraph.pl и speedscope).
+# Включается на ходу через /api/profiler и сам выключается через PROFILER_MAX_SECONDS.
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.01"))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "300"))
+
+class SamplingProfiler:
+    def __init__(self):
+        self.thread = None
+        self.target = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Вызывается из цикла событий — его поток и профилируется
+    def start(self, interval: float, seconds: float):
+        if self.running():
+            return False
+        self.target = threading.get_ident()
+        with self.lock:
+            self.stacks = Counter()
+            self.samples = 0
+        self.started = time.time()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(interval, seconds), name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+    def _run(self, interval: float, seconds: float):
+        deadline = time.monotonic() + seconds
+        while not self.stop_event.wait(interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            with self.lock:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def collapsed(self):
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def status(self):
+        return {"running": self.running(), "samples": self.samples, "started": self.started}
+
+profiler = SamplingProfiler()
+
+# /metrics и профилировщик: токен METRICS_TOKEN (заголовок Authorization: Bearer)
+# или initData администратора. Без METRICS_TOKEN — только администраторы.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+def ops_authorized(request):
+    if METRICS_TOKEN and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return True
+    return roster.is_admin(webapp_user_id(request))
+
+# Состояния диалогов в работе; у Redis их не пересчитываем — это полный обход ключей
+def fsm_state_counts():
+    if isinstance(fsm_storage, SQLiteStorage):
+        return fsm_storage.state_counts()
+    if isinstance(fsm_storage, MemoryStorage):
+        return Counter(record.state for record in fsm_storage.storage.values() if record.state)
+    return None
+
+@metrics.collector
+def collect_gauges():
+    metrics.set("bot_uptime_seconds", round(time.monotonic() - PROCESS_STARTED, 3))
+    metrics.set("write_queue_pending", write_queue.size())
+    metrics.set("sheets_write_requests_last_minute", sum(1 for t in write_queue.request_times if time.monotonic() - t <= 60))
+    metrics.set("sheets_write_quota_per_minute", SHEETS_WRITES_PER_MINUTE)
+    metrics.set("outbox_queue_depth", outbox.queue.qsize())
+    metrics.set("event_stream_clients", len(events.clients))
+    metrics.set("orders_cached", len(orders_repo.records))
+    counts = fsm_state_counts()
+    if counts is not None:
+        metrics.reset("fsm_states")
+        for state, count in counts.items():
+            metrics.set("fsm_states", count, {"state": state})
+
+# Задержка цикла событий: насколько позже срока просыпается sleep
+async def monitor_event_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        metrics.observe("event_loop_lag_seconds", lag)
+        metrics.set("event_loop_lag_last_seconds", lag)
+
+# 🆕 Метрики для Prometheus
+async def metrics_endpoint(request):
+    if not ops_authorized(request):
+        return web.Response(status=403, text="Forbidden")
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-store"})
+
+# 🆕 Профилировщик: POST {"action": "start", "interval": 0.01, "seconds": 60} | {"action": "stop"};
+# GET — состояние, GET ?format=collapsed — свёрнутые стеки
+async def profiler_api(request):
+    if not ops_authorized(request):
+        return web.json_response({"error": "Forbidden"}, status=403)
+    if request.method == "POST":
+        try:
+            data = await request.json() if request.can_read_body else {}
+            action = data.get("action", "start")
+            if action == "start":
+                interval = max(float(data.get("interval", PROFILER_INTERVAL)), 0.001)
+                seconds = min(float(data.get("seconds", PROFILER_MAX_SECONDS)), PROFILER_MAX_SECONDS)
+                if not profiler.start(interval, seconds):
+                    return web.json_response({"error": "Уже запущен", **profiler.status()}, status=409)
+                logger.info(f"🔬 Профилировщик запущен на {seconds:.0f} с, интервал {interval} с")
+            elif action == "stop":
+                profiler.stop()
+            else:
+                return web.json_response({"error": "Неверный action"}, status=400)
+        except (ValueError, TypeError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+    if request.query.get("format") == "collapsed":
+        return web.Response(text=profiler.collapsed(), content_type="text/plain", charset="utf-8")
+    return web.json_response(profiler.status())
+
+# При остановке сервера открытые потоки событий завершаются сами
+async def close_event_streams(app):
+    events.close()
+
+# 🆕 Проверка живости для балансировщика: процесс запущен и отвечает.
+# Не зависит от Google — деплой проходит проверку и во время сбоя таблиц.
+async def live_check(request):
+    return web.json_response({"alive": True})
+
+# 🆕 API готовности: прогреты ли кэши и сколько занял запуск
+async def ready_check(request):
+    return web.json_response(
+        {
+            "ready": data_ready.is_set(),
+            "sheets_connected": all(
+                mirror.worksheet is not None for mirror in (orders_mirror, shifts_mirror) if mirror is not None
+            ),
+            "pending_writes": write_queue.size(),
+            "startup": startup_timings,
+        },
+        status=200 if data_ready.is_set() else 503,
+    )
+
 # Глобальный обработчик ошибок
 @dp.errors()
-async def errors_handler(update, exception):
-    logger.error(f"❌ Глобальная ошибка: {exception}")
+async def errors_handler(event: types.ErrorEvent):
+    metrics.inc("bot_errors_total", {"exception": type(event.exception).__name__})
+    logger.error(f"❌ Глобальная ошибка: {event.exception}", exc_info=event.exception)
     return True
 
-# Главная функция
-async def main():
-    logger.info("🚀 Бот запускается...")
-    await set_bot_commands()
-    
-    # Создаем веб-сервер
-    app = web.Application()
+# Время и исход каждого обработчика бота
+async def track_handler(handler, event, data):
+    name = getattr(data["handler"].callback, "__name__", "handler")
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await handler(event, data)
+        outcome = "ok"
+        return result
+    finally:
+        metrics.inc("bot_handler_calls_total", {"handler": name, "outcome": outcome})
+        metrics.observe("bot_handler_duration_seconds", time.perf_counter() - started, {"handler": name})
+
+dp.message.middleware(track_handler)
+dp.callback_query.middleware(track_handler)
+
+# Время и код ответа по маршрутам веб-сервера (шаблон маршрута, не путь — иначе
+# каждый /media/<хэш> стал бы отдельной серией)
+@web.middleware
+async def track_requests(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        labels = {"method": request.method, "route": route}
+        metrics.inc("http_requests_total", {**labels, "status": status})
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - started, labels)
+
+# Пока кэши не прогреты, API отвечает 503, а не ждёт Google
+@web.middleware
+async def require_data_ready(request, handler):
+    if (
+        not data_ready.is_set()
+        and request.path.startswith("/api/")
+        and request.path not in ("/api/live", "/api/ready", "/api/profiler")
+        and request.method != "OPTIONS"
+    ):
+        return web.json_response(
+            {"success": False, "error": "Starting up"}, status=503, headers={"Retry-After": "5"}
+        )
+    return await handler(request)
+
+# Бот тоже ждёт прогрева, но недолго — иначе просит повторить позже
+@dp.update.outer_middleware()
+async def wait_for_data(handler, event: types.Update, data):
+    if not data_ready.is_set():
+        try:
+            await asyncio.wait_for(data_ready.wait(), STARTUP_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            if event.message:
+                await event.message.answer("⏳ Бот запускается, повторите через минуту.")
+            elif event.callback_query:
+                await event.callback_query.answer("⏳ Бот запускается, повторите через минуту.")
+            return None
+    return await handler(event, data)
+
+# Веб-сервер со всеми маршрутами; bench.py поднимает его же без main()
+def create_app():
+    app = web.Application(middlewares=[track_requests, require_data_ready])
+    app.on_shutdown.append(close_event_streams)
     
     # Настраиваем CORS
     cors = aiohttp_cors.setup(app, defaults={
@@ -787,6 +4096,36 @@ async def main():
     # Добавляем маршруты
     resource = cors.add(app.router.add_resource("/api/orders"))
     cors.add(resource.add_route("GET", get_orders))
+
+    resource = cors.add(app.router.add_resource("/api/orders/nearest"))
+    cors.add(resource.add_route("GET", get_nearest_orders))
+
+    resource = cors.add(app.router.add_resource("/api/upload_photo"))
+    cors.add(resource.add_route("POST", upload_photo))
+
+    resource = cors.add(app.router.add_resource("/api/media"))
+    cors.add(resource.add_route("GET", list_media))
+
+    resource = cors.add(app.router.add_resource("/media/{digest}"))
+    cors.add(resource.add_route("GET", serve_media))
+
+    resource = cors.add(app.router.add_resource("/media/{digest}/{variant}"))
+    cors.add(resource.add_route("GET", serve_media))
+
+    resource = cors.add(app.router.add_resource("/api/reports"))
+    cors.add(resource.add_route("GET", get_reports))
+
+    resource = cors.add(app.router.add_resource("/api/export"))
+    cors.add(resource.add_route("GET", export_orders_api))
+
+    resource = cors.add(app.router.add_resource("/api/orders/changes"))
+    cors.add(resource.add_route("GET", get_order_changes))
+
+    resource = cors.add(app.router.add_resource("/api/sync"))
+    cors.add(resource.add_route("POST", sync_actions))
+
+    resource = cors.add(app.router.add_resource("/api/events"))
+    cors.add(resource.add_route("GET", stream_events))
     
     resource = cors.add(app.router.add_resource("/api/start_order"))
     cors.add(resource.add_route("POST", start_order))
@@ -797,16 +4136,64 @@ async def main():
     resource = cors.add(app.router.add_resource("/api/update_location"))
     cors.add(resource.add_route("POST", update_location))
     
+    resource = cors.add(app.router.add_resource("/api/arrive_at_order"))
+    cors.add(resource.add_route("POST", arrive_at_order))
+
     resource = cors.add(app.router.add_resource("/api/sos_alert"))
     cors.add(resource.add_route("POST", sos_alert))
     
-    # Запускаем веб-сервер и бота
+    resource = cors.add(app.router.add_resource("/api/live"))
+    cors.add(resource.add_route("GET", live_check))
+
+    resource = cors.add(app.router.add_resource("/api/ready"))
+    cors.add(resource.add_route("GET", ready_check))
+
+    resource = cors.add(app.router.add_resource("/api/profiler"))
+    cors.add(resource.add_route("GET", profiler_api))
+    cors.add(resource.add_route("POST", profiler_api))
+
+    app.router.add_get("/metrics", metrics_endpoint)
+    
+    # Webhook: проверяем секретный токен, сразу отвечаем 200, обновление обрабатывается в фоне
+    if BOT_MODE == "webhook":
+        SimpleRequestHandler(
+            dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    return app
+
+# Главная функция
+async def main():
+    logger.info("🚀 Бот запускается...")
+    app = create_app()
+    
+    # Запускаем веб-сервер, данные и команды подтягиваются в фоне
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', 8080)
     await site.start()
+    mark_startup("http_ready")
+    
+    asyncio.create_task(warm_up())
+    asyncio.create_task(write_queue.run())
+    asyncio.create_task(locations.run())
+    asyncio.create_task(outbox.run())
+    asyncio.create_task(media.run())
+    asyncio.create_task(monitor_event_loop())
     
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise Exception("❌ Для BOT_MODE=webhook укажите WEBHOOK_URL.")
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"🔗 Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
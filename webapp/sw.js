@@ -39,27 +39,28 @@ self.addEventListener('sync', event => {
     }
 });
 
+//      
 async function syncOfflineOrders() {
     const offlineOrders = JSON.parse(localStorage.getItem('offline_orders') || '[]');
-    if (offlineOrders.length > 0) {
-        for (const order of offlineOrders) {
-            try {
-                const response = await fetch('/api/sync_order', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(order)
-                });
-                if (response.ok) {
-                    //   -
-                    const index = offlineOrders.indexOf(order);
-                    if (index > -1) {
-                        offlineOrders.splice(index, 1);
-                        localStorage.setItem('offline_orders', JSON.stringify(offlineOrders));
-                    }
-                }
-            } catch (error) {
-                console.error(' :', error);
-            }
+    if (offlineOrders.length === 0) {
+        return;
+    }
+    try {
+        const response = await fetch('/api/sync', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ actions: offlineOrders })
+        });
+        const data = await response.json();
+        if (data.success) {
+            //    ,    ;   
+            const done = new Set(data.results
+                .filter(r => r.success || ['Conflict', 'Order not found', 'Forbidden'].includes(r.error))
+                .map(r => r.id));
+            const rest = offlineOrders.filter(a => !done.has(a.id));
+            localStorage.setItem('offline_orders', JSON.stringify(rest));
         }
+    } catch (error) {
+        console.error(' :', error);
     }
 }
\ No newline at end of file